@@ -34,6 +34,13 @@ class SQLite3assist(SQLassist):
 
     _SQLshowtables = 'SELECT name FROM main.sqlite_master WHERE type="table";'
     _SQLshowschema = 'PRAGMA table_info({});'
+    _SQLtuning = (
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA temp_store=MEMORY',
+        'PRAGMA cache_size=-64000',
+        'PRAGMA mmap_size=268435456',
+        'PRAGMA journal_size_limit=67108864',
+    )
 
     # Crossover data so all "base" classes have it.
     SCHEMA_VERSION = LibrarianDBackendSQL.SCHEMA_VERSION
@@ -43,9 +50,13 @@ class SQLite3assist(SQLassist):
             uri = 'file:%s' % self.db_file
             if self.ro:
                 uri += '?mode=ro'
+            # The sqlite3 module keeps an LRU of prepared statements keyed
+            # by SQL text.  Size it so every backend statement, including
+            # the per-shape book queries, stays compiled.
             self._conn = sqlite3.connect(uri,
                                          uri=True,
-                                         isolation_level='EXCLUSIVE')
+                                         isolation_level='EXCLUSIVE',
+                                         cached_statements=512)
             self._cursor = self._conn.cursor()
         except Exception as e:
             raise RuntimeError('Cannot open %s: %s' % (self.db_file, str(e)))
@@ -57,6 +68,12 @@ class SQLite3assist(SQLassist):
             dir = os.path.dirname(os.path.realpath(self.db_file))
             raise RuntimeError('Cannot open WAL journal in %s' % dir)
 
+        # In WAL mode NORMAL only syncs at checkpoint, still crash-safe.
+        # Negative cache_size is in KiB.  Reads come through a 256M mmap
+        # and the WAL file is trimmed back to 64M after checkpoints.
+        for pragma in self._SQLtuning:
+            self.execute(pragma)
+
     def __init__(self, **kwargs):
         super(self.__class__, self).__init__(**kwargs)
         self.DBname = kwargs['db_file']
@@ -103,6 +120,34 @@ class SQLite3assist(SQLassist):
         self._execAndCheck(sql, values, commit)
         pass
 
+    # Multi-row flavors: one executemany() instead of a round trip per
+    # row.  Every row is expected to change exactly one record.
+
+    def _execmanyAndCheck(self, sql, rows, commit):
+        assert rows, 'missing values for %s' % sql
+        try:
+            self.executemany(sql, rows)
+        except Exception as e:  # includes sqlite3.Error
+            raise AssertionError('%s failed: %s' % (sql, str(e)))
+        if self.rowcount != len(rows):
+            self.rollback()
+            raise AssertionError('%s failed: rowcount mismatch' % (sql))
+        if commit:
+            self.commit()
+
+    def INSERTMANY(self, table, rows, commit=True):
+        '''Rows are COMPLETE tuples following ordered schema.'''
+        assert rows, 'missing values for INSERT INTO %s' % table
+        qmarks = ', '.join(['?'] * len(rows[0]))
+        sql = 'INSERT INTO %s VALUES (%s)' % (table, qmarks)
+        self._execmanyAndCheck(sql, rows, commit)
+
+    def UPDATEMANY(self, table, setclause, rows, commit=False):
+        '''setclause is effective key=val, key=val sequence'''
+        assert setclause, 'missing setclause for UPDATE'
+        sql = 'UPDATE %s SET %s' % (table, setclause)
+        self._execmanyAndCheck(sql, rows, commit)
+
     #
     # sqlite: if PRIMARY, but not AUTOINC, you get autoinc behavior and
     # hole-filling.  Explicitly setting id overrides that.
@@ -22,10 +22,9 @@
 
 import errno
 import os
-import random
 import sys
 from pdb import set_trace
-from collections import defaultdict
+from collections import defaultdict, deque
 
 from book_shelf_bos import TMBook
 from frdnode import BooksIGInterpretation as BII    # for constants
@@ -36,18 +35,23 @@ from frdnode import BooksIGInterpretation as BII    # for constants
 # user.LFS.xxxxx intrinsics.  Start with general logic checks.
 
 
-def _node_id2ig(node_id, mode=BII.MODE_LZA):
-    '''Right now nodes go from 1-80 but IGs are 0-79'''
+def _node_id2ig(node_id, IGtag=BII.MODE_LZA << BII.MODE_SHIFT):
+    '''Right now nodes go from 1-80 but IGs are 0-79.  IGtag is the
+       BIImode already shifted into place.'''
     assert 0 < node_id <= 80, 'Bad node value'
     # Overload IG field with BIImode before DB query
-    return (node_id - 1) | (mode << BII.MODE_SHIFT)
+    return (node_id - 1) | IGtag
 
 
 class BookPolicy(object):
 
-    _policies = ('RandomBooks', 'LocalNode', 'LocalEnc', 'NonLocal_Enc',
-                 'Nearest', 'NearestRemote', 'NearestEnc', 'NearestRack',
-                 'LZAascending', 'LZAdescending', 'RequestIG')
+    # Keep the ordered tuple for user.LFS.AllocationPolicyList output;
+    # membership tests use the frozenset.
+    _policies_ordered = (
+        'RandomBooks', 'LocalNode', 'LocalEnc', 'NonLocal_Enc',
+        'Nearest', 'NearestRemote', 'NearestEnc', 'NearestRack',
+        'LZAascending', 'LZAdescending', 'RequestIG')
+    _policies = frozenset(_policies_ordered)
 
     DEFAULT_ALLOCATION_POLICY = 'RandomBooks'    # mutable
 
@@ -105,14 +109,13 @@ class BookPolicy(object):
                     'Bad AllocationPolicy "%s"' % value
         elif xattr == cls.XATTR_ALLOCATION_POLICY_LIST:
             assert not setting, no_set
-            value = ','.join(cls._policies)
+            value = ','.join(cls._policies_ordered)
         elif elems[2] == 'Interleave':
             assert not setting, no_set
-            bos = LCEobj.db.get_books_on_shelf(shelf)
-            value = bytes([ b.intlv_group & BII.IG_MASK for b in bos ]).decode()
+            value = LCEobj.db.get_shelf_intlv_groups(shelf).decode()
         elif xattr == cls.XATTR_ALLOCATION_POLICY_DEFAULT:
             if setting:
-                legal = frozenset(cls._policies) - frozenset(('RequestIG',))
+                legal = cls._policies - frozenset(('RequestIG',))
                 assert value in legal, 'Bad %s value: %s' % (xattr, value)
                 cls.DEFAULT_ALLOCATION_POLICY = value
             else:
@@ -124,16 +127,31 @@ class BookPolicy(object):
    #-----------------------------------------------------------------------
     # Return a list of books or raise an error.
 
+    # Topology doesn't change while the Librarian runs so only check it
+    # the first time a given node list is seen.
+    _IG_node_checked = None
+
     def __init__(self, LCEobj, shelf, context):
         '''LCEobj members are used to enforce the 1:1 IG:node assumption'''
-        if LCEobj.BII.is_MODE_LZA:
-            assert len(LCEobj.IGs) == len(LCEobj.nodes), 'IG:node != 1:1'
+        if self._IG_node_checked is not LCEobj.nodes:
+            if LCEobj.BII.is_MODE_LZA:
+                assert len(LCEobj.IGs) == len(LCEobj.nodes), 'IG:node != 1:1'
+            BookPolicy._IG_node_checked = LCEobj.nodes
         LCEobj.errno = errno.EINVAL
         self.LCEobj = LCEobj
         self.shelf = shelf
         self.context = context
+        # Fixed for the life of this object, don't redo them per policy call
+        self._node_id = int(context['node_id'])
+        self._IGtag = LCEobj.BII() << BII.MODE_SHIFT
         self.name = LCEobj.db.get_xattr(shelf, 'user.LFS.AllocationPolicy')
         assert self.name in self._policies, 'Unknown policy "%s"' % self.name
+        # Name is fixed for the life of this object so resolve it once.
+        # AssertionError is a "gentler" reporting path back to user.
+        LCEobj.errno = errno.ENOSYS
+        self._policy_func = getattr(self, '_policy_' + self.name, None)
+        assert self._policy_func is not None, \
+            '"%s" is not implemented' % self.name
 
     def __str__(self):
         return '%s policy=%s' % (self.shelf.name, self.name)
@@ -142,13 +160,11 @@ class BookPolicy(object):
         return self.__str__()
 
     def _IGs2books(self, books_needed, IGs, exclude=False, shuffle=True):
+        '''Up to books_needed free books from IGs.  With shuffle the DB
+           picks them at random, no Python-side shuffle or sampling.'''
         db = self.LCEobj.db
-        # Randomization needs to work with EVERY possible book
-        tmp = 999999 if shuffle else books_needed
-        books = db.get_books_by_intlv_group(tmp, IGs, exclude=exclude)
-        if shuffle:
-            random.shuffle(books)
-        return books[:books_needed]
+        return db.get_books_by_intlv_group(
+            books_needed, IGs, exclude=exclude, random=shuffle)
 
     # For "NUMA" distance calculations there are three sources
     # (Node | Enc | OffEnc aka Rack), eight states.
@@ -204,9 +220,38 @@ class BookPolicy(object):
             node_ids = (node_ids, )
         if not node_ids:
             return []
-        IGs = [ _node_id2ig(n, self.LCEobj.BII()) for n in node_ids ]
+        IGs = [ _node_id2ig(n, self._IGtag) for n in node_ids ]
         return self._IGs2books(books_needed, IGs, shuffle=shuffle)
 
+    # Node topology is fixed once the Librarian is running, so calculate
+    # the enclosure/off-enclosure node sets once instead of on every call.
+    _nearest_nodes = None
+    _nearest_sets = None
+
+    @classmethod
+    def _nearest_node_ids(cls, LCEobj):
+        '''Return {node_id: (enc_node_ids, nonenc_node_ids)} where the
+           enclosure tuple does not include node_id itself.'''
+        if cls._nearest_nodes is not LCEobj.nodes:
+            extant_node_ids = sorted(n.node_id for n in LCEobj.nodes)
+            sets = {}
+            for caller in LCEobj.nodes:
+                caller_id = caller.node_id
+                # Assume all SD Flex partitions are in a single rack/enc
+                if LCEobj.BII.is_MODE_PHYSADDR:
+                    enc_node_ids = frozenset(extant_node_ids)
+                else:
+                    enc_node_ids = frozenset((n.node_id for n in LCEobj.nodes
+                        if n.enc == caller.enc))
+                sets[caller_id] = (
+                    tuple(n for n in extant_node_ids
+                          if n in enc_node_ids and n != caller_id),
+                    tuple(n for n in extant_node_ids
+                          if n not in enc_node_ids))
+            cls._nearest_sets = sets
+            cls._nearest_nodes = LCEobj.nodes
+        return cls._nearest_sets
+
     def _policy_Nearest(self, books_needed,
             fromLocal=True, fromEnc=True, fromRack=True):
         '''Get books closest to calling SoC.  Stop when enough books are
@@ -215,16 +260,9 @@ class BookPolicy(object):
         assert fromLocal or fromEnc or fromRack, \
             '_policy_Nearest(): nothing selected'
 
-        caller_id = int(self.context['node_id'])
-        caller = [n for n in self.LCEobj.nodes if n.node_id == caller_id][0]
-        extant_node_ids = frozenset(n.node_id for n in self.LCEobj.nodes)
-
-        # Assume all SD Flex partitions are in a single rack/enc
-        if self.LCEobj.BII.is_MODE_PHYSADDR:
-            enc_node_ids = frozenset(n.node_id for n in self.LCEobj.nodes)
-        else:
-            enc_node_ids = frozenset((n.node_id for n in self.LCEobj.nodes
-                if n.enc == caller.enc))
+        caller_id = self._node_id
+        enc_node_ids, nonenc_node_ids = self._nearest_node_ids(
+            self.LCEobj)[caller_id]
 
         localbooks = []
         encbooks = []
@@ -245,8 +283,7 @@ class BookPolicy(object):
 
         # Where does the next batch come from?
         if fromEnc:
-            candidate_ids = enc_node_ids - frozenset((caller_id, ))
-            encbooks = self._node_ids2books(books_needed, candidate_ids)
+            encbooks = self._node_ids2books(books_needed, enc_node_ids)
 
             # Are there enough additional books in this enclosure?
             books_needed -= len(encbooks)
@@ -256,8 +293,7 @@ class BookPolicy(object):
 
         # How about the final batch?
         if fromRack:
-            candidate_ids = extant_node_ids - enc_node_ids
-            nonencbooks = self._node_ids2books(books_needed, candidate_ids)
+            nonencbooks = self._node_ids2books(books_needed, nonenc_node_ids)
 
             # It doesn't really matter if there are enough, this is it
             books_needed -= len(nonencbooks)
@@ -267,19 +303,18 @@ class BookPolicy(object):
 
     def _policy_RandomBooks(self, books_needed):
         '''Using all IGs, select random books from all of FAM.'''
-        notIGs = (99999,)
-        return self._IGs2books(books_needed, notIGs, exclude=True, shuffle=True)
+        # No IG filter at all, rather than excluding a bogus IG.
+        return self._IGs2books(books_needed, (), shuffle=True)
 
-    def _policy_LZAascending(self, books_needed, ascending=True):
-        '''Using all IGs, select books from all of FAM in specified order.'''
-        db = self.LCEobj.db
-        freebooks = db.get_books_by_intlv_group(
-            books_needed, (999999, ), exclude=True, ascending=ascending)
-        return freebooks
+    def _policy_LZAascending(self, books_needed):
+        '''Using all IGs, select books from all of FAM in LZA order.'''
+        return self.LCEobj.db.get_books_by_intlv_group(
+            books_needed, (), ascending=True)
 
     def _policy_LZAdescending(self, books_needed):
-        freebooks = self._policy_LZAascending(books_needed, ascending=False)
-        return freebooks
+        '''Using all IGs, select books from all of FAM in reverse LZA order.'''
+        return self.LCEobj.db.get_books_by_intlv_group(
+            books_needed, (), ascending=False)
 
     def _policy_RequestIG(self, books_needed):
         '''Select books from IGs specified in interleave_request attribute.
@@ -295,15 +330,17 @@ class BookPolicy(object):
         # Get a starting position for the interleave_request list
         self.LCEobj.errno = errno.ENOSPC
         pos = db.get_xattr(self.shelf, self.XATTR_IG_REQ_POS)
-        try:
-            ig_pos = int(pos)
+        if pos is None:     # TSNH, see create_shelf.  Legacy paranoia.
+            ig_pos = 0
+            resp = db.create_xattr(self.shelf, self.XATTR_IG_REQ_POS, ig_pos,
+                                   commit=False)   # see modify_xattr below
+        else:
+            try:
+                ig_pos = int(pos)
+            except ValueError as err:
+                ig_pos = 0
             if ig_pos < 0 or ig_pos > (len(ig_req) - 1):
                 ig_pos = 0
-        except TypeError as err:    # TSNH, see create_shelf.  Legacy paranoia.
-            ig_pos = 0
-            resp = db.create_xattr(self.shelf, self.XATTR_IG_REQ_POS, ig_pos)
-        except ValueError as err:
-            ig_pos = 0
 
         reqIGs = [ord(ig_req[i:i+1]) for i in range(0, len(ig_req), 1)]
 
@@ -319,9 +356,9 @@ class BookPolicy(object):
         booksIG = {}
         for ig in igCnt.keys():
             # Overload IG field with BIImode before DB query
-            mod_ig = ig | self.LCEobj.BII() << BII.MODE_SHIFT
-            booksIG[ig] = db.get_books_by_intlv_group(
-                igCnt[ig], (mod_ig, ), exclude=False)
+            mod_ig = ig | self._IGtag
+            booksIG[ig] = deque(db.get_books_by_intlv_group(
+                igCnt[ig], (mod_ig, ), exclude=False))
 
         # Build list of books using request_interleave pattern
         self.LCEobj.errno = errno.ENOSPC
@@ -330,23 +367,21 @@ class BookPolicy(object):
         for cnt in range(0, books_needed):
             ig = reqIGs[cur % len(reqIGs)]
             assert len(booksIG[ig]) != 0, 'Not enough books remaining in IG'
-            bookList.append(booksIG[ig].pop(0))
+            bookList.append(booksIG[ig].popleft())
             cur += 1
 
-        # Save current position in interleave_request list
-        db.modify_xattr(self.shelf, self.XATTR_IG_REQ_POS, cur % len(reqIGs))
+        # Save current position in interleave_request list.  The caller
+        # (cmd_resize_shelf) holds a transaction, which commits this along
+        # with the book claims or rolls it back with them.
+        db.modify_xattr(self.shelf, self.XATTR_IG_REQ_POS, cur % len(reqIGs),
+                        commit=False)
 
         return bookList
 
     def __call__(self, books_needed):
-        '''Look up the appropriate routine or throw an error'''
+        '''Invoke the policy routine resolved in __init__'''
         self.LCEobj.errno = errno.ENOSYS
-        try:
-            policy_func = self.__class__.__dict__['_policy_' + self.name]
-            return policy_func(self, books_needed)
-        except KeyError as e:
-            # AssertionError is a "gentler" reporting path back to user
-            raise AssertionError('"%s" is not implemented' % self.name)
+        return self._policy_func(books_needed)
 
 ###########################################################################
 # This is NOT for testing, just a quick entry without the full Librarian.
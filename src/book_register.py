@@ -163,7 +163,7 @@ def extrapolate_global_section(Gname, G, node_count, book_size_bytes):
     bytes_per_node = multiplier(G['nvm_size_per_node'], Gname, book_size_bytes)
     if bytes_per_node % book_size_bytes != 0:
         usage('[%s] bytes_per_node not multiple of book size' % Gname)
-    books_per_node = int(bytes_per_node / book_size_bytes)
+    books_per_node = bytes_per_node // book_size_bytes
     module_size_books = books_per_node // 4
     if module_size_books * 4 != books_per_node:
         usage('Books per node is not divisible by 4')
@@ -649,7 +649,7 @@ def parse_all_sections(Gname, G, node_count, book_size_bytes, other_sections):
             # B. MODE_LZA
             assert nvm_size % book_size_bytes == 0, \
                 '%s NVM size is not multiple of book size' % errname
-            nbooks = int(nvm_size / book_size_bytes)
+            nbooks = nvm_size // book_size_bytes
             assert nbooks > 0, '%s %s book count must be > 0' % (
                 errname, sizeATaddr)
 
@@ -858,7 +858,7 @@ def load_book_data_json(jsonfile):
               (len(allRacks), len(allEnclosures), len(allNodes),
                len(allMCs), len(IGs)))
         print('book size = %s (%d)' % (config.bookSize, config.bookSize))
-        books_total = config.totalNVM / config.bookSize
+        books_total = config.totalNVM // config.bookSize
         print('%d books * %d bytes/book == %d (0x%016x) total NVM bytes' % (
             books_total, config.bookSize, config.totalNVM, config.totalNVM))
 
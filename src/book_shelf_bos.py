@@ -16,6 +16,7 @@
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
 import time
+from operator import attrgetter
 from pdb import set_trace
 
 #########################################################################
@@ -30,46 +31,50 @@ class BookShelfStuff(object):      # could become a mixin
 
     __slots__ = ()
 
-    _sorted = None
+    _fields = None   # per-subclass, see __init_subclass__
+    _schema_values = None
+    _public = None          # slots that go across the wire, see dict
+    _public_values = None
+    _tuple_getters = {}     # field names: attrgetter, shared by all classes
 
     def _msg(self, basemsg):
         return '%s: %s' % (self.__class__.__name__, basemsg)
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._fields = tuple(k for k in cls.__slots__ if k != cls._MFname)
+        cls._schema_values = attrgetter(*cls._ordered_schema)
+        cls._public = tuple(k for k in cls.__slots__ if k[0] != '_')
+        cls._public_values = attrgetter(*cls._public)
+
     def __init__(self, *args, **kwargs):
-        if not self._sorted:
-            self.__class__._sorted = tuple(sorted(self._ordered_schema))
         assert not (args and kwargs), self._msg(
             'full tuple or kwargs, not both')
         if args and isinstance(args[0], dict):
             kwargs = args[0]
-            args = None
-        if args:
+        elif args:
             assert len(args) == len(
                 self._ordered_schema), self._msg('bad arg count')
-            submitted = dict(zip(self._ordered_schema, args))
-            missing = {}
-        else:
-            submitted = frozenset(kwargs.keys())
-            missing = self.__slots__ - submitted - set((self._MFname,))
-            if False and not self.__slots__.issubset(submitted):
-                print('Missing fields "%s"' % (
-                    ', '.join(sorted([k for k in missing]))))
-            submitted = kwargs
-            missing = dict(zip(missing, (0, ) * len(missing)))
-
-        for src in (submitted, missing):
-            for k, v in src.items():
-                try:    # __slots__ is in play
-                    setattr(self, k, v)
-                except AttributeError as e:
-                    pass
+            kwargs = dict(zip(self._ordered_schema, args))
+        self._fill(kwargs.get)
+
+    def _fill(self, get):
+        # Every slot except matchfields gets a value, zero if missing.
+        for k in self._fields:
+            setattr(self, k, get(k, 0))
         setattr(self, self._MFname, None)
 
+    # This runs for every row pulled from the DB (see SQLassist.__next__)
+    # so skip __init__ and its kwargs repacking.
+    @classmethod
+    def from_row(cls, names, values):
+        self = cls.__new__(cls)
+        self._fill(dict(zip(names, values)).get)
+        return self
+
     def __eq__(self, other):
-        for k in self._ordered_schema:  # not ids
-            if getattr(self, k) != getattr(other, k):
-                return False
-        return True
+        # Objects are mutable so compare fresh value tuples, not cached ones
+        return self._schema_values(self) == other._schema_values(other)
 
     def __str__(self):
         s = []
@@ -90,12 +95,9 @@ class BookShelfStuff(object):      # could become a mixin
     # for (re)conversion to send back across the wire
     @property
     def dict(self):
-        d = {}
-        for k in self.__slots__:
-            if k[0] != '_':
-                val = getattr(self, k)
-                d[k] = val
-        return d
+        # Called per element on every list return so use the per-class
+        # getter, one C-level call, instead of a getattr() per slot.
+        return dict(zip(self._public, self._public_values(self)))
 
     # Be liberal in what I take, versus expecting people to remember
     # to *expand existing tuples.
@@ -104,8 +106,14 @@ class BookShelfStuff(object):      # could become a mixin
             if isinstance(args[0], tuple):  # probably matchfields
                 args = args[0]
         else:
-            args = self._ordered_schema
-        return tuple([getattr(self, a) for a in args])
+            return self._schema_values(self)
+        if len(args) < 2:   # attrgetter of one name isn't a tuple
+            return tuple([getattr(self, a) for a in args])
+        try:
+            return self._tuple_getters[args](self)
+        except KeyError:
+            getter = self._tuple_getters[args] = attrgetter(*args)
+            return getter(self)
 
     @property
     def schema(self):
@@ -169,15 +177,19 @@ class TMShelf(BookShelfStuff):
     # Gotta do this here or the mechanism doesn't work.  "bos" will
     # probably only be used on the client(s) as this type of info
     # is reasonably ephemeral in The Librarian.  _fd is only used
-    # by shadow_dir as the fd of the per-shelf backing file.
+    # by shadow_dir as the fd of the per-shelf backing file, and
+    # _book_bases and _fh_pid by shadow_support for the flat offset
+    # of each book and the owning pid of each open handle.
     __slots__ = frozenset((_ordered_schema) + (BookShelfStuff._MFname,
                                                'bos',
                                                'open_handle',
-                                               '_fd'))
+                                               '_fd',
+                                               '_book_bases',
+                                               '_fh_pid'))
 
-    def __init__(self, *args, **kwargs):
-        super(self.__class__, self).__init__(*args, **kwargs)
-        # super.__init__ sets things to zero if the constructor dict is
+    def _fill(self, get):
+        super(TMShelf, self)._fill(get)
+        # super._fill sets things to zero if the constructor dict is
         # missing them.  Some fields need a different "missing" value.
         if self.bos == 0:
             self.bos = [ ]
@@ -185,15 +197,27 @@ class TMShelf(BookShelfStuff):
             self.open_handle = None
         if self._fd == 0:
             self._fd = -1
+        if self._book_bases == 0:
+            self._book_bases = None
+        if self._fh_pid == 0:
+            self._fh_pid = None
+
+    def _clone(self):
+        '''Copy for the shadow cache without deepcopy's generic walk.
+           bos entries are flat dicts off the wire, one level is enough.'''
+        new = self.__class__.__new__(self.__class__)
+        for k in self.__slots__:
+            setattr(new, k, getattr(self, k))
+        new.bos = [ dict(b) for b in self.bos ]
+        return new
 
     def __eq__(self, other):
-        # If size_bytes match, then len(bos) must match.
+        # If size_bytes match, then len(bos) must match.  Order matters
+        # (see lfs_shadow) so a pairwise list compare is enough; the old
+        # "book not in other.bos" scan was quadratic in the book count.
         if self.id != other.id or self.size_bytes != other.size_bytes:
             return False
-        for book in self.bos:
-            if book not in other.bos:
-                return False
-        return True
+        return self.bos == other.bos
 
 #########################################################################
 
@@ -19,7 +19,6 @@
 # with this program.  If not, write to the Free Software Foundation, Inc.,
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
-import sys
 import threading
 from collections import OrderedDict
 from pdb import set_trace
@@ -217,12 +216,13 @@ class LibrarianCommandProtocol(object):
 
             return respdict
 
+        # Chain the original so the line number is there for whoever
+        # walks the traceback, without digging it out on every failure.
         except AssertionError as e:
-            msg = str(e)
+            raise RuntimeError(str(e)) from e
         except Exception as e:
-            msg = 'INTERNAL ERROR @ %s[%d]: %s' % (
-                self.__class__.__name__, sys.exc_info()[2].tb_lineno, str(e))
-        raise RuntimeError(msg)
+            raise RuntimeError('INTERNAL ERROR @ %s: %s' % (
+                self.__class__.__name__, str(e))) from e
 
     @property
     def commandset(self):
@@ -20,9 +20,7 @@
 #---------------------------------------------------------------------------
 
 import errno
-import uuid
 import time
-import math
 import stat
 import sys
 import traceback
@@ -31,12 +29,18 @@ from pdb import set_trace
 
 from book_policy import BookPolicy
 from book_shelf_bos import TMBook, TMShelf, TMBos
-from cmdproto import LibrarianCommandProtocol as lcp
-from frdnode import FRDnode, BooksIGInterpretation
+from frdnode import BooksIGInterpretation
 from genericobj import GenericObject
 
 _ZERO_PREFIX = '.lfs_pending_zero_'     # agree with lfs_fuse.py
 
+# The only legal state a book may be in before moving to each new state.
+_ALLOC_PRIOR = {
+    TMBook.ALLOC_INUSE: TMBook.ALLOC_FREE,
+    TMBook.ALLOC_ZOMBIE: TMBook.ALLOC_INUSE,
+    TMBook.ALLOC_FREE: TMBook.ALLOC_ZOMBIE,
+}
+
 
 class LibrarianCommandEngine(object):
 
@@ -60,7 +64,9 @@ class LibrarianCommandEngine(object):
 
     @classmethod
     def _nbooks(cls, nbytes):
-        return int(math.ceil(float(nbytes) / float(cls._book_size_bytes)))
+        # Integer ceiling division: exact for any size, no float round trip
+        bsz = cls._book_size_bytes
+        return (nbytes + bsz - 1) // bsz
 
     def cmd_version(self, cmdict):
         """ Return librarian version
@@ -69,7 +75,7 @@ class LibrarianCommandEngine(object):
             Out (dict) ---
                 librarian version
         """
-        return self.db.get_globals(only='version')
+        return self._globals.schema_version
 
     def cmd_get_fs_stats(self, cmdict):
         """ Return globals
@@ -78,7 +84,10 @@ class LibrarianCommandEngine(object):
             Out (dict) ---
                 librarian version
         """
-        lfs_globals = self.db.get_globals()
+        # The globals row is static after book_register, only books_used
+        # moves.  Hand out a copy so callers can't scribble on the cache.
+        lfs_globals = GenericObject(self._globals.dict)
+        lfs_globals['books_used'] = self.db.get_books_used()
         # books_per_IG has been expanded for MODE_PHYSADDR
         lfs_globals['books_per_IG'] = self.books_per_IG
         lfs_globals['BIImode'] = self.BII()
@@ -91,41 +100,52 @@ class LibrarianCommandEngine(object):
             Out (dict) ---
                 shelf data
         """
-        path_list = self._path2list(cmdict['path'])
-        cmdict['name'] = path_list[-1]
-        parent_shelf = self._path2shelf(path_list[:-1])
-        cmdict['parent_id'] = parent_shelf.id
-        cmdict['link_count'] = 1  # normal files get one
-
-        # POSIX: if extant, open it; else create and then open
-        try:
-            shelf = self.cmd_open_shelf(cmdict)
+        # POSIX: if extant, open it; else create and then open.  A miss
+        # is the common case so branch on it instead of raising.  The
+        # lookup also fills in cmdict name and parent_id.
+        shelf = self._try_get_shelf(cmdict)
+        if shelf is not None:
+            self.db.modify_opened_shelves(shelf, 'get', cmdict['context'])
             return shelf
-        except Exception as e:
-            pass
+        cmdict['link_count'] = 1  # normal files get one
         self.errno = errno.EINVAL
         shelf = TMShelf(cmdict)
-        self.db.create_shelf(shelf)
-        self.db.create_xattr(shelf,
-                             BookPolicy.XATTR_ALLOCATION_POLICY,
-                             BookPolicy.DEFAULT_ALLOCATION_POLICY)
-
-        # Will be ignored until AllocationPolicy set to RequestIG.  I just
-        # want it to show up in a full xattr dump (getfattr -d /lfs/xxxx)
-        self.db.create_xattr(shelf, BookPolicy.XATTR_IG_REQ, '')
-        self.db.create_xattr(shelf, BookPolicy.XATTR_IG_REQ_POS, '')
-
-        return self.cmd_open_shelf(cmdict)  # Does the handle thang
+        # Shelf row, default xattrs and the open handle are one transaction
+        # committed by the open.  The new shelf is in hand so there's no
+        # need to look it up again.
+        with self.db.transaction():
+            self.db.create_shelf(shelf, commit=False)
+            # IG_REQ* will be ignored until AllocationPolicy is set to
+            # RequestIG.  I just want them to show up in a full xattr
+            # dump (getfattr -d /lfs/xxxx)
+            self.db.create_xattrs(shelf, (
+                (BookPolicy.XATTR_ALLOCATION_POLICY,
+                 BookPolicy.DEFAULT_ALLOCATION_POLICY),
+                (BookPolicy.XATTR_IG_REQ, ''),
+                (BookPolicy.XATTR_IG_REQ_POS, '')))
+            self.db.modify_opened_shelves(shelf, 'get', cmdict['context'])
+        return shelf
 
-    def cmd_get_shelf(self, cmdict, match_id=False, match_parent_id=True):
+    def cmd_get_shelf(self, cmdict, match_id=False, match_parent_id=True,
+                      bundle=False):
         """ List a given shelf.
             In (dict)---
                 path
                 optional flag to force a match on id (ie, already open)
                 optional flag to force a match on parent_id, defaulted to True
+                optional flag to also fetch the open count (internal)
             Out (TMShelf object) ---
-                TMShelf object
+                TMShelf object, or db.get_shelf_bundle() object if bundle
         """
+        ret = self._try_get_shelf(cmdict, match_id, match_parent_id, bundle)
+        if ret is None:
+            self.errno = errno.ENOENT  # FIXME: raise OSError instead?
+            raise AssertionError('no such shelf %s' % cmdict['name'])
+        return ret
+
+    def _try_get_shelf(self, cmdict, match_id=False, match_parent_id=True,
+                       bundle=False):
+        '''cmd_get_shelf() that returns None for a missing shelf.'''
         self.errno = errno.EINVAL
         path_list = self._path2list(cmdict['path'])
         try:
@@ -148,16 +168,19 @@ class LibrarianCommandEngine(object):
             shelf.matchfields = ('name', 'id')
         else:
             shelf.matchfields = ('name', )
-        shelf = self.db.get_shelf(shelf)
+        if bundle:
+            ret = self.db.get_shelf_bundle(shelf, want_bos=False)
+            shelf = ret.shelf if ret is not None else None
+        else:
+            ret = shelf = self.db.get_shelf(shelf)
         if shelf is None:
-            self.errno = errno.ENOENT  # FIXME: raise OSError instead?
-            raise AssertionError('no such shelf %s' % cmdict['name'])
+            return None
         # consistency checks
         self.errno = errno.EBADF
         assert self._nbooks(shelf.size_bytes) == shelf.book_count, (
             '%s size metadata mismatch' % shelf.name)
         self.errno = errno.ESTALE
-        return shelf
+        return ret
 
     def cmd_list_shelves(self, cmdict):
         '''Returns a list.'''
@@ -218,11 +241,15 @@ class LibrarianCommandEngine(object):
         shelf = self.db.modify_opened_shelves(shelf, 'put', cmdict['context'])
         return shelf
 
-    def _list_shelf_books(self, shelf):
-        '''Short form: merely the book-shelf assocation, no book details.'''
+    def _list_shelf_books(self, shelf, books=False):
+        '''Short form: merely the book-shelf assocation, no book details.
+           With books=True return the TMBooks themselves, in BOS order.'''
         self.errno = errno.EBADF
         assert shelf.id, '%s not open' % shelf.name
-        bos = self.db.get_bos_by_shelf_id(shelf.id)
+        if books:
+            bos = self.db.get_books_on_shelf(shelf)
+        else:
+            bos = self.db.get_bos_by_shelf_id(shelf.id)
 
         # consistency checks.  Leave them both as different paths may
         # have been followed to retrieve the passed-in shelf.
@@ -250,15 +277,12 @@ class LibrarianCommandEngine(object):
             book = self.db.get_book_by_id(bookorbos.book_id)
         if newalloc == book.allocated:
             return book
-        msg = 'Book allocation %d -> %d' % (book.allocated, newalloc)
-        if newalloc == TMBook.ALLOC_INUSE:
-            assert book.allocated == TMBook.ALLOC_FREE, msg
-        elif newalloc == TMBook.ALLOC_ZOMBIE:
-            assert book.allocated == TMBook.ALLOC_INUSE, msg
-        elif newalloc == TMBook.ALLOC_FREE:
-            assert book.allocated == TMBook.ALLOC_ZOMBIE, msg
-        else:
+        try:
+            prior = _ALLOC_PRIOR[newalloc]
+        except KeyError:
             raise RuntimeError('Bad book allocation %d' % newalloc)
+        assert book.allocated == prior, 'Book allocation %d -> %d' % (
+            book.allocated, newalloc)
         book.allocated = newalloc
         book.matchfields = 'allocated'
         book = self.db.modify_book(book)
@@ -309,10 +333,19 @@ class LibrarianCommandEngine(object):
             self.db.modify_shelf(new_parent_shelf, commit=True)
 
         if shelf.name.startswith(_ZERO_PREFIX):  # zombify and unblock
-            bos = self.db.get_bos_by_shelf_id(shelf.id)
-            while bos:
-                thisbos = bos.pop()
-                _ = self._set_book_alloc(thisbos, TMBook.ALLOC_ZOMBIE)
+            # Books come back with the BOS JOIN, not one lookup per BOS
+            books = self.db.get_books_on_shelf(shelf)
+            self.errno = errno.EUCLEAN
+            zombify = []
+            for book in books:
+                if book.allocated == TMBook.ALLOC_INUSE:
+                    zombify.append(book.id)
+                else:
+                    assert book.allocated == TMBook.ALLOC_ZOMBIE, \
+                        'Book allocation %d -> %d' % (
+                            book.allocated, TMBook.ALLOC_ZOMBIE)
+            self.db.modify_books_alloc(
+                zombify, TMBook.ALLOC_INUSE, TMBook.ALLOC_ZOMBIE)
             if shelf.mode & stat.S_IFBLK:
                 # Turn into normal file so zeroing tools don't choke
                 shelf.mode = stat.S_IFREG
@@ -335,17 +368,30 @@ class LibrarianCommandEngine(object):
                 shelf data
         """
         self.errno = errno.EBUSY
-        shelf = self.cmd_get_shelf(cmdict)
-        assert not self.db.open_count(
-            shelf), '%s has active opens' % shelf.name
-        bos = self._list_shelf_books(shelf)
-        xattrs = self.db.list_xattrs(shelf)
-        for thisbos in bos:
-            self.db.delete_bos(thisbos)
-            _ = self._set_book_alloc(thisbos, TMBook.ALLOC_ZOMBIE)
-        for xattr in xattrs:
-            self.db.remove_xattr(shelf, xattr)
-        rsp = self.db.delete_shelf(shelf, commit=True)
+        # Shelf and open count in one backend call
+        bundle = self.cmd_get_shelf(cmdict, bundle=True)
+        shelf = bundle.shelf
+        assert not bundle.open_count, '%s has active opens' % shelf.name
+        # Books are only checked in aggregate, never pulled into Python
+        counts = self.db.get_shelf_alloc_counts(shelf.id)
+        self.errno = errno.EREMOTEIO
+        assert sum(counts.values()) == shelf.book_count, (
+            '%s book count mismatch' % shelf.name)
+        self.errno = errno.EUCLEAN
+        bad = set(counts) - set((TMBook.ALLOC_INUSE, TMBook.ALLOC_ZOMBIE))
+        assert not bad, 'Book allocation %d -> %d' % (
+            min(bad), TMBook.ALLOC_ZOMBIE)
+        # Set-oriented: a handful of statements, one commit.  Books are
+        # found through BOS so zombify them before dropping the BOS.
+        with self.db.transaction():
+            nzombies = self.db.modify_shelf_books_alloc(
+                shelf.id, TMBook.ALLOC_INUSE, TMBook.ALLOC_ZOMBIE)
+            assert nzombies == counts.get(TMBook.ALLOC_INUSE, 0), \
+                'Book allocation change to %d failed' % TMBook.ALLOC_ZOMBIE
+            self.db.delete_bos_by_shelf_id(shelf.id)
+            # One DELETE on the (shelf_id, xattr) index; no list first
+            self.db.remove_all_xattrs(shelf)
+            rsp = self.db.delete_shelf(shelf)
 
         return rsp
 
@@ -375,17 +421,24 @@ class LibrarianCommandEngine(object):
                 z_shelf_path
         """
         shelf = self.cmd_get_shelf(cmdict, match_id=True)
-        bos = self._list_shelf_books(shelf)
+        # Same checks as _list_shelf_books() but done in SQL so no BOS
+        # rows are pulled in.  cmd_get_shelf() checked size vs. count.
+        # The summary only feeds asserts so skip the scan under -O.
+        if __debug__:
+            nbos, nseqs, minseq, maxseq = self.db.get_bos_summary(shelf.id)
+            self.errno = errno.EREMOTEIO
+            assert nbos == shelf.book_count, (
+                '%s book count mismatch' % shelf.name)
+            if nbos:
+                # nbos distinct values within 1..nbos is exactly 1..nbos
+                self.errno = errno.EBADFD
+                assert nseqs == nbos and minseq == 1 and maxseq == nbos, (
+                    'Corrupt BOS sequence progression for %s' % shelf.name)
         new_size_bytes = int(cmdict['size_bytes'])
         self.errno = errno.EINVAL
         assert new_size_bytes >= 0, 'Bad size'
         new_book_count = self._nbooks(new_size_bytes)
         out_buf = {'z_shelf_path': None}
-        if bos:
-            seqs = [ b.seq_num for b in bos ]
-            self.errno = errno.EBADFD
-            assert set(seqs) == set(range(1, shelf.book_count + 1)), (
-                'Corrupt BOS sequence progression for %s' % shelf.name)
 
         # Can I leave real early?
         if new_size_bytes == shelf.size_bytes:
@@ -407,100 +460,110 @@ class LibrarianCommandEngine(object):
             shelf = self.db.modify_shelf(shelf, commit=True)
             return out_buf
 
-        books_needed = new_book_count - shelf.book_count
-        if books_needed > 0:
-            policy = BookPolicy(self, shelf, cmdict['context'])
-            freebooks = policy(books_needed)
-            self.errno = errno.ENOSPC
-            assert len(freebooks) == books_needed, \
-                'out of space for "%s"' % shelf.name
-            seq_num = shelf.book_count
-            for book in freebooks:  # Mark book in use and create BOS entry
-                book = self._set_book_alloc(book, TMBook.ALLOC_INUSE)
-                seq_num += 1
-                thisbos = TMBos(
-                    shelf_id=shelf.id, book_id=book.id, seq_num=seq_num)
-                thisbos = self.db.create_bos(thisbos)
-        elif books_needed < 0:
-            books_2bdel = -books_needed  # it all reads so much better
-            self.errno = errno.EREMOTEIO
-            assert len(bos) >= books_2bdel, 'Book removal problem'
-            # The unlink workflow has one step which zero truncates
-            # a file with a certain name.  IOW not all shelves are USED,
-            # some may be full of ZOMBIES
-            freeing = shelf.name.startswith(
-                _ZERO_PREFIX) and not new_book_count
-            zero_enabled = cmdict['zero_enabled']
-
-            if not freeing and zero_enabled:
-                # Create a zeroing shelf for the books being removed
-                z_shelf_name = (_ZERO_PREFIX + shelf.name + '_' + str(shelf.parent_id) +
-                                '_' + str(time.time()) + '_' + cmdict['context']['physloc'])
-                # all are placed in root, so path is easy
-                z_shelf_path = '/' + z_shelf_name
-                z_shelf_data = {}
-                z_shelf_data.update({'context': cmdict['context']})
-                z_shelf_data.update({'name': z_shelf_name})
-                # place all zeroing shelves at root (/lfs) with parent_id = 2
-                # this makes sure that they are not placed in a directory that
-                # is removed before they can be zeroed and deleted themselves
-                z_shelf_data.update({'parent_id': 2})
-                self.errno = errno.EINVAL
-                z_shelf = TMShelf(z_shelf_data)
-                self.db.create_shelf(z_shelf)
-                z_seq_num = 1
-
-            while books_2bdel > 0:
+        # Everything from here to the shelf update is one transaction,
+        # committed at the end or rolled back on any failure.
+        with self.db.transaction():
+            books_needed = new_book_count - shelf.book_count
+            if books_needed > 0:
+                policy = BookPolicy(self, shelf, cmdict['context'])
+                freebooks = policy(books_needed)
+                self.errno = errno.ENOSPC
+                assert len(freebooks) == books_needed, \
+                    'out of space for "%s"' % shelf.name
+                # Mark books in use and create BOS entries, one batch each.
+                # The "AND allocated=FREE" guard in modify_books_alloc() makes
+                # the claim atomic: a book taken since the policy looked is a
+                # rowcount mismatch.  Either way leave nothing half-claimed.
+                newbos = [ TMBos(shelf_id=shelf.id, book_id=book.id,
+                                 seq_num=seq_num)
+                           for seq_num, book in enumerate(
+                                freebooks, start=shelf.book_count + 1) ]
+                self.errno = errno.EUCLEAN
+                self.db.modify_books_alloc([ book.id for book in freebooks ],
+                    TMBook.ALLOC_FREE, TMBook.ALLOC_INUSE)
+                self.db.create_bos_many(newbos)
+            elif books_needed < 0:
+                books_2bdel = -books_needed  # it all reads so much better
+                self.errno = errno.EREMOTEIO
+                assert shelf.book_count >= books_2bdel, 'Book removal problem'
+                # The unlink workflow has one step which zero truncates
+                # a file with a certain name.  IOW not all shelves are USED,
+                # some may be full of ZOMBIES
+                freeing = shelf.name.startswith(
+                    _ZERO_PREFIX) and not new_book_count
+                zero_enabled = cmdict['zero_enabled']
+
+                if not freeing and zero_enabled:
+                    # Create a zeroing shelf for the books being removed
+                    z_shelf_name = (_ZERO_PREFIX + shelf.name + '_' + str(shelf.parent_id) +
+                                    '_' + str(time.time()) + '_' + cmdict['context']['physloc'])
+                    # all are placed in root, so path is easy
+                    z_shelf_path = '/' + z_shelf_name
+                    z_shelf_data = {}
+                    z_shelf_data.update({'context': cmdict['context']})
+                    z_shelf_data.update({'name': z_shelf_name})
+                    # place all zeroing shelves at root (/lfs) with parent_id = 2
+                    # this makes sure that they are not placed in a directory that
+                    # is removed before they can be zeroed and deleted themselves
+                    z_shelf_data.update({'parent_id': 2})
+                    self.errno = errno.EINVAL
+                    z_shelf = TMShelf(z_shelf_data)
+                    # Born at its final size and committed with the resize
+                    # below, so it never needs a second UPDATE.
+                    z_shelf.size_bytes = books_2bdel * self.book_size_bytes
+                    z_shelf.book_count = books_2bdel
+                    self.db.create_shelf(z_shelf, commit=False)
+                    z_seq_num = 1
+                    out_buf = {'z_shelf_path': z_shelf_path}
+
+                # Books come off the end of the shelf, last one first.  All
+                # of it is set-oriented SQL on the BOS tail; the books never
+                # come into Python.  BOS go last as they find the books.
+                first_seq = new_book_count + 1
                 try:
-                    thisbos = bos.pop()
-                    self.db.delete_bos(thisbos)         # Orphans the book
-                    new_state = TMBook.ALLOC_ZOMBIE
-                    book = self.db.get_book_by_id(thisbos.book_id)
-                    if freeing and book.allocated == TMBook.ALLOC_ZOMBIE:
-                        new_state = TMBook.ALLOC_FREE
-                    if new_state != book.allocated:     # staying ZOMBIE
-                        _ = self._set_book_alloc(book, new_state)
-                    books_2bdel -= 1
+                    counts = self.db.get_shelf_alloc_counts(
+                        shelf.id, first_seq)
+                    assert sum(counts.values()) == books_2bdel, \
+                        'Book removal mismatch'
+                    for allocated in counts:
+                        if allocated not in (TMBook.ALLOC_INUSE,
+                                             TMBook.ALLOC_ZOMBIE):
+                            raise AssertionError('Book allocation %d -> %d' % (
+                                allocated, TMBook.ALLOC_ZOMBIE))
+                    # ZOMBIEs on a freeing shelf are released, else they stay
+                    transitions = [ (TMBook.ALLOC_INUSE, TMBook.ALLOC_ZOMBIE) ]
+                    if freeing:
+                        transitions.insert(
+                            0, (TMBook.ALLOC_ZOMBIE, TMBook.ALLOC_FREE))
+                    for oldalloc, newalloc in transitions:
+                        changed = self.db.modify_shelf_books_alloc(
+                            shelf.id, oldalloc, newalloc, first_seq)
+                        assert changed == counts.get(oldalloc, 0), \
+                            'Book allocation change to %d failed' % newalloc
 
                     if not freeing and zero_enabled:
-                        # Add removed book to zeroing shelf
-                        z_thisbos = TMBos(shelf_id=z_shelf.id,
-                                          book_id=book.id, seq_num=z_seq_num)
-                        z_thisbos = self.db.create_bos(z_thisbos)
-                        z_shelf.size_bytes += self.book_size_bytes
-                        z_shelf.book_count += 1
-                        z_seq_num += 1
+                        # Add removed books to zeroing shelf
+                        self.db.copy_bos_reversed(
+                            shelf.id, first_seq, shelf.book_count,
+                            z_shelf.id, z_seq_num)
+
+                    self.db.delete_bos_by_shelf_id(     # Orphans the books
+                        shelf.id, first_seq=first_seq)
 
                 except Exception as e:
-                    self.db.rollback()
                     self.errno = errno.EREMOTEIO
                     raise RuntimeError(
                         'Resizing shelf smaller failed: %s' % str(e))
 
-            if not freeing and zero_enabled:
-                z_shelf.matchfields = ('size_bytes', 'book_count')
-                z_shelf = self.db.modify_shelf(z_shelf, commit=True)
-                out_buf = {'z_shelf_path': z_shelf_path}
-
-        else:
-            self.db.rollback()
-            self.errno = errno.EREMOTEIO
-            raise RuntimeError('Bad code path in cmd_resize_shelf()')
+            else:
+                self.errno = errno.EREMOTEIO
+                raise RuntimeError('Bad code path in cmd_resize_shelf()')
 
-        shelf.book_count = new_book_count
-        shelf.matchfields = ('size_bytes', 'book_count')
-        shelf = self.db.modify_shelf(shelf, commit=True)
+            shelf.book_count = new_book_count
+            shelf.matchfields = ('size_bytes', 'book_count')
+            shelf = self.db.modify_shelf(shelf)
         return out_buf
 
-    def cmd_get_shelf_zaddr(cmd_data, cmdict):
-        """
-            In (dict)---
-                ?
-            Out (dict) ---
-                ?
-        """
-        raise NotImplementedError
-
     def cmd_get_book(self, cmdict):
         """ List a given book
             In (dict)---
@@ -609,6 +672,8 @@ class LibrarianCommandEngine(object):
             'OOBmsg': cmdict['msg']
         }
 
+    cmd_send_OOB._produces_oob = True  # only these get OOBmsg extraction
+
     def cmd_get_book_ig(self, cmdict):
         allocated = [ TMBook.ALLOC_FREE,
                       TMBook.ALLOC_INUSE, TMBook.ALLOC_ZOMBIE ]
@@ -749,6 +814,24 @@ class LibrarianCommandEngine(object):
     #######################################################################
 
     _commands = None
+    _globals = None     # static row from book_register, see __init__
+
+    # Create method lookup table by stripping the 'cmd_' prefix.  Done
+    # once per class when it's defined, not per instance.  dir() instead
+    # of __dict__ so subclasses inherit commands.
+    @classmethod
+    def _build_commands(cls):
+        cls._commands = dict(
+            [(name[4:], getattr(cls, name))
+             for name in dir(cls) if name.startswith('cmd_')])
+        cls._commandset = tuple(sorted(cls._commands.keys()))
+        cls._oob_commands = frozenset(
+            [name for (name, func) in cls._commands.items()
+             if getattr(func, '_produces_oob', False)])
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._build_commands()
 
     def __init__(self, backend, optargs=None, cooked=False):
         innerE = None
@@ -756,6 +839,7 @@ class LibrarianCommandEngine(object):
         try:
             self.db = backend
             lfs_globals = self.db.get_globals()
+            self.__class__._globals = lfs_globals
             (self.__class__._book_size_bytes,
              self.__class__._nvm_bytes_total) = (
                 lfs_globals.book_size_bytes,
@@ -764,6 +848,8 @@ class LibrarianCommandEngine(object):
 
             self.__class__.nodes = self.db.get_nodes()
             assert self.nodes, 'Database has no nodes'
+            self.__class__._node_ids = frozenset(
+                [ n.node_id for n in self.nodes ])
             if self.verbose:
                 racknum = 1
                 racknodes = [ n for n in self.nodes if n.rack == racknum ]
@@ -803,17 +889,18 @@ class LibrarianCommandEngine(object):
                 # Here, "IG" is synonymous with "chunk of contiguous memory".
                 # Right now there's just one per compute partition but
                 # expansion is possible.  Or barefoot nodes.
-                for ignum in range(0, 100):     # Plenty for 990x
-                    self.db.execute('''SELECT COUNT(*) FROM books
-                                       WHERE intlv_group & 0xffff = ?''',
-                                       (ignum,))
-                    tmp = self.db.fetchone()
-                    assert len(tmp) == 1, 'BIImode unexpected DB return'
-                    tmp = tmp[0]
-                    if tmp:
-                        IGs.append(GenericObject(
-                            groupId=ignum,
-                            total_books=tmp))
+                # One grouped pass over books instead of a query per ignum.
+                # Books were stored in order so the lowest id is the base
+                # address for the contiguous block of the overloaded IG.
+                self.db.execute('''SELECT intlv_group & 0xffff AS ignum,
+                                          COUNT(*), MIN(id) FROM books
+                                   WHERE ignum < 100
+                                   GROUP BY ignum ORDER BY ignum''')
+                for ignum, tmp, base in self.db.fetchall():  # Plenty for 990x
+                    IGs.append(GenericObject(
+                        groupId=ignum,
+                        total_books=tmp,
+                        physaddr=base))
                 # Idiot check, probably books with ignum > 100
                 self.db.execute('''SELECT COUNT(*) FROM books''')
                 tmp = self.db.fetchone()[0]
@@ -837,26 +924,24 @@ class LibrarianCommandEngine(object):
             # Legacy just sent books per IG value, now also send raw physaddr.
             # That value for legacy MODE_LZA is -1.
 
-            self.__class__.books_per_IG = dict(
-                [ (ig.groupId, [ig.total_books, -1]) for ig in IGs]
-            )
             if self.BII.is_MODE_PHYSADDR:
-                # Books were stored in order.  The first book is the base
-                # address for the contiguous block of the overloaded IG.
-                tag = self.BII.MODE_PHYSADDR << self.BII.MODE_SHIFT
-                for id, elems in self.books_per_IG.items():
-                    tmp = self.db.get_books_by_intlv_group(
-                        1, [tag | id, ], allocated='ANY', ascending=True)
-                    assert len(tmp) == 1, 'Books table is corrupt'
-                    elems[1] = tmp[0].id
-
-            # Create method lookup table by stripping the 'cmd_' prefix
-
-            self.__class__._commands = dict(
-                [(name[4:], func)
-                 for (name, func) in self.__class__.__dict__.items() if
-                 name.startswith('cmd_')])
+                self.__class__.books_per_IG = dict(
+                    [ (ig.groupId, [ig.total_books, ig.physaddr])
+                      for ig in IGs]
+                )
+            else:
+                self.__class__.books_per_IG = dict(
+                    [ (ig.groupId, [ig.total_books, -1]) for ig in IGs]
+                )
+
+            # The class command table was built at import time, see
+            # _build_commands.  Each instance gets bound methods so
+            # __call__ can invoke them directly.
+            self._dispatch = dict(
+                [(name, func.__get__(self))
+                 for (name, func) in self._commands.items()])
             self._cooked = cooked  # return style: raw = dict, cooked = obj
+            self._heartbeats = {}  # node_id: last SOC heartbeat written
 
         except Exception as e:      # raising here is not clean
             innerE = '%s line %d: %s' % (
@@ -872,7 +957,7 @@ class LibrarianCommandEngine(object):
         try:
             self.errno = 0
             context = cmdict['context']
-            command = self._commands[cmdict['command']]
+            command = self._dispatch[cmdict['command']]
         except KeyError as e:
             # This comment might go better in the module that imports json.
             # From StackOverflow: NULL is not zero. It's not a value, per se:
@@ -889,15 +974,20 @@ class LibrarianCommandEngine(object):
             return { 'errmsg': errmsg, 'errno': errno.ENOSYS }, None
 
         try:
-            # If this is a performance problem, cache node_id
-            assert FRDnode(int(cmdict['context']['node_id'])) in self.nodes, \
+            node_id = context['node_id']
+            nid = int(node_id)
+            # Set membership instead of building an FRDnode per request
+            assert nid in self._node_ids, \
                 'Node is not configured in Librarian topology'
-            # Advance the last-known-contact timestamp.
-            self.db.modify_node_soc_status(cmdict['context']['node_id'])
+            # Advance the last-known-contact timestamp.  It has one second
+            # resolution so skip the UPDATE + commit if it wouldn't move.
+            now = int(time.time())
+            if self._heartbeats.get(nid) != now:
+                self.db.modify_node_soc_status(node_id)
+                self._heartbeats[nid] = now
             errmsg = ''  # High-level internal errors, not LFS state errors
-            self.errno = 0
-            ret = OOBmsg = None
-            ret = command(self, cmdict)
+            OOBmsg = None
+            ret = command(cmdict)
         except (AssertionError, RuntimeError) as e:  # programmed checks
             errmsg = str(e)
         except Exception as e:  # the Unknown Idiot needs some help
@@ -913,7 +1003,7 @@ class LibrarianCommandEngine(object):
                       file=sys.stderr)
             return { 'errmsg': errmsg, 'errno': self.errno }, None
 
-        if isinstance(ret, dict):
+        if cmdict['command'] in self._oob_commands and isinstance(ret, dict):
             OOBmsg = ret.get('OOBmsg', None)
             if OOBmsg is not None:
                 OOBmsg = { 'OOBmsg': OOBmsg }
@@ -936,4 +1026,7 @@ class LibrarianCommandEngine(object):
 
     @property
     def commandset(self):
-        return tuple(sorted(self._commands.keys()))
+        return self._commandset
+
+
+LibrarianCommandEngine._build_commands()   # subclasses do it themselves
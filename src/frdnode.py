@@ -89,6 +89,8 @@ class BooksIGInterpretation():
 class FRDnodeID(object):
     """Reverse-calculation of a node ID 1-80 from enc 1-8  and node 1-10."""
 
+    __slots__ = ()      # so FRDFAModule can be slotted
+
     @property
     def node_id(self):
         return (self.rack - 1) * 80 + (self.enc - 1) * 10 + self.node
@@ -113,6 +115,11 @@ class FRDFAModule(FRDnodeID):
     MC_STATUS_OFFLINE = 0
     MC_STATUS_ACTIVE = 1
 
+    # There are several per node, kept for the life of the Librarian.
+    # memorySize is added later by book_register.py.
+    __slots__ = ('module_size_books', 'rack', 'enc', 'node', 'ordMC',
+                 'rawCID', 'coordinate', 'memorySize')
+
     def __init__(self, STRorCID=None, enc=None, node=None, ordMC=None,
                  module_size_books=0):
         self.module_size_books = module_size_books
@@ -84,15 +84,10 @@ def _20_finish_unlink(db):
         return
     for shelf in partial:
         print('\tremoving %s' % (shelf.name))
-        # get_bos(shelf) returns TMBook objects, but I want TMBos
-        bos = db.get_bos_by_shelf_id(shelf.id)
-        for thisbos in bos:
-            db.delete_bos(thisbos)
-            book = db.get_book_by_id(thisbos.book_id)
-            if book.allocated == TMBook.ALLOC_INUSE:
-                book.allocated = TMBook.ALLOC_ZOMBIE
-                book.matchfields = 'allocated'
-                db.modify_book(book)
+        # Books are found through BOS so zombify before dropping them
+        db.modify_shelf_books_alloc(
+            shelf.id, TMBook.ALLOC_INUSE, TMBook.ALLOC_ZOMBIE)
+        db.delete_bos_by_shelf_id(shelf.id)
         db.delete_shelf(shelf)
         db.commit()
 
@@ -678,6 +678,13 @@ class LibrarianFS(Operations):  # Name shows up in mount point
         shelf = TMShelf(rsp)
         return self.shadow.read(shelf, length, offset, fh)
 
+    @prentry
+    def readinto(self, path, buf, offset, fh):
+        # read() straight into the tmfs buffer, see TMFS.read
+        rsp = self.librarian(self.lcp('get_shelf', path=path))
+        shelf = TMShelf(rsp)
+        return self.shadow.readinto(shelf, buf, offset, fh)
+
     @prentry
     def write(self, path, buf, offset, fh):
         # FIXME: see read comment
@@ -767,7 +774,7 @@ class LibrarianFS(Operations):  # Name shows up in mount point
     def flush(self, path, fh):
         '''May be called zero, one, or more times per shelf open.  It's a
            chance to report delayed errors, not a syscall passthru.'''
-        return 0
+        return self.shadow.flush(fh)
 
     # @prentry
     # def opendir(self, path, *args, **kwargs):
@@ -996,6 +1003,11 @@ if __name__ == '__main__':
         help='file path for one regular shadow file',
         type=str,
         default='')
+    parser.add_argument(
+        '--write_behind',
+        help='queue --shadow_dir writes to a worker thread (not mmap coherent until flush)',
+        action='store_true',
+        default=False)
     parser.add_argument(
         '--verbose',
         help='level of runtime output (0=ERROR, 1=PERF, 2=NOTICE, 3=INFO, 4=DEBUG, 5=OOB)',
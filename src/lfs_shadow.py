@@ -20,25 +20,26 @@
 # including book_register.py rewrites.
 
 import errno
-import math
+import logging
 import os
 import stat
 import struct
 import sys
-import tempfile
 import mmap
 import ctypes
+import queue
+import threading
 
-from copy import deepcopy
-from subprocess import getoutput
+from itertools import chain
 from pdb import set_trace
 
 from frdnode import BooksIGInterpretation as BII
+from genericobj import GenericObject
 from tm_fuse import TmfsOSError, tmfs_get_context
 import tm_ioctl_opt as IOCTL
 
 #--------------------------------------------------------------------------
-# _shelfcache is essentially a copy of the Librarian's "opened_shelves"
+# The shelf cache is essentially a copy of the Librarian's "opened_shelves"
 # table data generated on the fly.  The goal was to avoid a round trip
 # to the Librarian for many FuSE interactions.  This class duck-types a
 # dict with multiple keys (name and file handles).  The value is a single,
@@ -50,6 +51,10 @@ import tm_ioctl_opt as IOCTL
 # EDIT: the dictionary is being modified to index by shelf id instead of name
 # so that same name shelves in different directories can still be acted upon
 
+# The (shelf.id, None) / (None, fh) tuple keys are the external interface.
+# Internally they're two plain int-keyed dicts, _by_id and _by_fh, so the
+# per-IO lookups don't build and hash a tuple.
+
 # shadow file and shadow directory yet to be implemented for subs
 
 
@@ -70,8 +75,11 @@ class shadow_support(object):
         self.verbose = args.verbose
         self.logger = args.logger
         self.book_size = lfs_globals['book_size_bytes']
-        self.book_shift = int(math.log(self.book_size, 2))
-        self._shelfcache = { }
+        self.book_shift = self.book_size.bit_length() - 1    # power of 2
+        self.book_mask = self.book_size - 1
+        self._by_id = { }   # shelf.id: cached shelf
+        self._by_fh = { }   # open handle: same cached shelf
+        self._last_shadow = (None, None)    # (shelf.id, bases), see below
         self.zero_on_unlink = True
 
         # The field is called aperture_base even if direct mapping is used.
@@ -124,11 +132,8 @@ class shadow_support(object):
 
     def _consistent(self, cached):
         try:
-            all_fh = [ ]
-            for vlist in cached.open_handle.values():
-                all_fh += vlist
-            for v_fh in all_fh:
-                assert (None, v_fh) in self._shelfcache, 'Inconsistent list members'
+            for v_fh in cached._fh_pid:
+                assert v_fh in self._by_fh, 'Inconsistent list members'
         except Exception as e:
             self.logger.error('Shadow cache is corrupt: %s' % str(e))
             if self.verbose > 3:
@@ -150,8 +155,9 @@ class shadow_support(object):
         # DO NOT change following lookup from (shelf.id, None) to key, although it
         # mirrors one possible key. If it exists at all it has to be found here,
         # if not breaks upon multiple opens
-        cached = self[(shelf.id, None)]
+        cached = self._by_id.get(shelf.id)
         pid = tmfs_get_context()[2]
+        self._last_shadow = (None, None)    # BOS may be about to change
 
         # Is it a completely new addtion?  Remember, only cache open shelves.
         if cached is None:
@@ -159,22 +165,26 @@ class shadow_support(object):
                 return
             # Create a copy because "open_handle" will be redefined.  This
             # single copy will be retrievable by the shelf name and all of
-            # its open handles.  The copy itself has a list of the fh keys
-            # indexed by pid, so open_handle.keys() is all the pids.
-            cached = deepcopy(shelf)
-            self._shelfcache[(cached.id, None)] = cached
-            self._shelfcache[key] = cached
+            # its open handles.  The copy itself has a set of the fh keys
+            # indexed by pid, so open_handle.keys() is all the pids, and
+            # the reverse map _fh_pid so no fh lookup walks every pid.
+            cached = shelf._clone()
+            self._by_id[cached.id] = cached
+            self._by_fh[key[1]] = cached
             cached.open_handle = { }
             # was key, hopefully key[1] still holds
-            cached.open_handle[pid] = [ key[1], ]
+            cached.open_handle[pid] = { key[1] }
+            cached._fh_pid = { key[1]: pid }
             return
 
         self._consistent(cached)    # As long as I'm here...
 
         # Has the shelf changed somehow?  If so, replace the cached copy
         # and perhaps take other steps.  Break down the comparisons in
-        # book_shelf_bos.py::TMShelf::__eq__()
-        if cached != shelf:
+        # book_shelf_bos.py::TMShelf::__eq__(), which already tries id and
+        # size_bytes before the bos lists.  rename() hands back the cached
+        # object itself, which needs no compare at all.
+        if cached is not shelf and cached != shelf:
             invalidate = True   # and work to make it false
             assert cached.id == shelf.id, 'Shelf aliasing error?'  # TSNH :-)
 
@@ -189,7 +199,8 @@ class shadow_support(object):
 
             # Update cached object variant fields.  Beware references.
             cached.size_bytes = shelf.size_bytes
-            cached.bos = deepcopy(shelf.bos)
+            cached.bos = [ dict(b) for b in shelf.bos ]
+            cached._book_bases = None   # see shadow_offset
             cached.book_count = shelf.book_count
             cached.mtime = shelf.mtime
 
@@ -201,25 +212,30 @@ class shadow_support(object):
 
         # fh is unique (created by Librarian as table index).  Does it
         # need to be appended?
-        if not isinstance(fh, int) or (None, fh) in self._shelfcache:
+        if not isinstance(fh, int) or fh in self._by_fh:
             return
-        self._shelfcache[key] = cached
+        self._by_fh[key[1]] = cached
         try:
-            cached.open_handle[pid].append(key[1])  # again, now key[1]
+            cached.open_handle[pid].add(key[1])     # again, now key[1]
         except KeyError as e:
-            cached.open_handle[pid] = [ key[1], ]  # new pid, same as ^^
+            cached.open_handle[pid] = { key[1] }    # new pid, same as ^^
+        cached._fh_pid[key[1]] = pid
 
     def __getitem__(self, key):
         '''Part of the support for duck-typing a dict with multiple keys.
            Suppress KeyError, returning None if no value exists.'''
-        return self._shelfcache.get(key, None)
+        shelf_id, fh = key
+        if fh is None:
+            return self._by_id.get(shelf_id)
+        return self._by_fh.get(fh)
 
     def __contains__(self, key):
         '''Part of the support for duck-typing a dict with multiple keys.'''
-        return key in self._shelfcache
+        return self[key] is not None
 
     def __delitem__(self, key):
         '''Part of the support for duck-typing a dict with multiple keys.'''
+        self._last_shadow = (None, None)
         cached = self[key]
         if cached is None:
             # Not currently open, something like "rm somefile"
@@ -230,73 +246,128 @@ class shadow_support(object):
         self._consistent(cached)    # As long as I'm here...
 
         # and now delete
-        del self._shelfcache[key]  # always
         if key[1] is not None:
             # Remove this direct shelf reference plus the back link
+            del self._by_fh[key[1]]
             open_handles = cached.open_handle
-            for pid, fhlist in open_handles.items():
-                if key[1] in fhlist:
-                    fhlist.remove(key[1])
-                    if not fhlist:
-                        del open_handles[pid]
-                    if not open_handles:            # Last reference
-                        del self._shelfcache[(cached.id, None)]
-                    return
-            # There has to be one
-            raise AssertionError('Cannot find fh to delete')
+            try:
+                pid = cached._fh_pid.pop(key[1])
+            except KeyError as e:
+                # There has to be one
+                raise AssertionError('Cannot find fh to delete')
+            fhlist = open_handles[pid]
+            fhlist.remove(key[1])
+            if not fhlist:
+                del open_handles[pid]
+            if not open_handles:            # Last reference
+                del self._by_id[cached.id]
+            return
 
         # It's a string so remove the whole thing.  This is only called
         # from unlink; so VFS has done the filtering job on open handles.
+        del self._by_id[key[0]]
         if cached.open_handle is None:  # probably "unlink"ing
             return
-        all_fh = [ ]
-        open_handles = cached.open_handle
-        if open_handles is not None:
-            for vlist in cached.open_handle.values():
-                all_fh += vlist
-            all_fh = frozenset(all_fh)  # paranoid: remove dupes
-            for fh in all_fh:
-                del self._shelfcache[(None, fh)]
+        for fh in cached._fh_pid:       # keys are unique
+            del self._by_fh[fh]
 
     def keys(self):
         '''Part of the support for duck-typing a dict with multiple keys.'''
-        return self._shelfcache.keys()
+        return chain(((shelf_id, None) for shelf_id in self._by_id),
+                     ((None, fh) for fh in self._by_fh))
 
     def items(self):
         '''Part of the support for duck-typing a dict with multiple keys.'''
-        return self._shelfcache.items()
+        return chain((((shelf_id, None), v)
+                      for shelf_id, v in self._by_id.items()),
+                     (((None, fh), v) for fh, v in self._by_fh.items()))
 
     def values(self):
         '''Part of the support for duck-typing a dict with multiple keys.'''
-        return self._shelfcache.values()
+        return chain(self._by_id.values(), self._by_fh.values())
 
     # End of dictionary duck typing, now use that cache
 
+    def _flat_book_bases(self, bos):
+        '''Flat shadow (file) offset of the start of each book in bos'''
+        # Offset into flat space has several contributors.  The concatenated
+        # LZA field has already been broken down into constituent parts.
+        # Note: in BII.MODE_LZA there are absolute values to work with in
+        # book['id'].  Turns out the IG-relative math works just fine.
+        # ig_base is absolute, book_num is relative to it.
+        igstart = self._igstart
+        mask = BII.VALUE_MASK
+        shift = self.book_shift
+        return tuple([
+            igstart[book['intlv_group'] & mask] + (book['book_num'] << shift)
+            for book in bos ])
+
+    def _shelf_bases(self, shelf):
+        '''Flat offsets of the books of a cached shelf, see below'''
+        # Book starts are computed once per cached BOS, not per IO, and
+        # streaming IO to one shelf skips even the cache lookup.
+        last_id, bases = self._last_shadow
+        if last_id != shelf.id:
+            bases = self._cached_bases(self._by_id[shelf.id])
+            self._last_shadow = (shelf.id, bases)
+        return bases
+
+    def _cached_bases(self, cached):
+        bases = cached._book_bases
+        if bases is None:
+            bases = cached._book_bases = self._flat_book_bases(cached.bos)
+        return bases
+
     def shadow_offset(self, shelf, shelf_offset):
         '''Translate shelf-relative offset to flat shadow (file) offset'''
-        bos = self[(shelf.id, None)].bos
-        bos_index = shelf_offset // self.book_size  # (0..n)
+        bases = self._shelf_bases(shelf)
+        bos_index = shelf_offset >> self.book_shift  # (0..n)
 
         # Stop FS read ahead past shelf, but what about writes?  Later.
-        try:
-            book = bos[bos_index]
-        except Exception as e:
+        if bos_index >= len(bases):
             return -1
 
-        # Offset into flat space has several contributors.  The concatenated
-        # LZA field has already been broken down into constituent parts.
-        # Note: in BII.MODE_LZA there are absolute values to work with in
-        # book['id'].  Turns out the IG-relative math works just fine.
-        intlv_group = book['intlv_group'] & BII.VALUE_MASK
-        book_num = book['book_num']                     # Relative to IG
-        ig_base = self._igstart[intlv_group]            # absolute
-        book_start = book_num * self.book_size          # relative to ig_base
-        book_offset = shelf_offset % self.book_size     # relative to book
-        tmp = ig_base + book_start + book_offset
+        tmp = bases[bos_index] + (shelf_offset & self.book_mask)
         if self.aperture_size:  # Based on BIImode
             assert tmp < self.aperture_size, 'BAD SHADOW OFFSET'
         return tmp
 
+    def _book_chunks(self, shelf, offset, length):
+        '''Split a shelf IO at book boundaries.  Yields (shadow_offset,
+           chunk length, offset into the IO buffer) per run of books
+           touched, where books adjacent in the shadow space are one run.
+           shadow_offset is -1 past the end of the shelf.'''
+        # shadow_offset() inlined: only the first chunk can start inside
+        # a book, the rest walk consecutive entries of the bases tuple.
+        # Merging runs means one syscall for all of them, not one per book.
+        bases = self._shelf_bases(shelf)
+        nbases = len(bases)
+        aperture_size = self.aperture_size
+        book_size = self.book_size
+        bos_index = offset >> self.book_shift
+        book_offset = offset & self.book_mask
+        buf_offset = 0
+        run_start = run_length = run_buf = 0
+        while buf_offset < length:
+            cur_length = min(book_size - book_offset, length - buf_offset)
+            if bos_index < nbases:
+                tmp = bases[bos_index] + book_offset
+                if aperture_size:
+                    assert tmp < aperture_size, 'BAD SHADOW OFFSET'
+            else:
+                tmp = -1
+            if run_length and tmp != -1 and tmp == run_start + run_length:
+                run_length += cur_length
+            else:
+                if run_length:
+                    yield run_start, run_length, run_buf
+                run_start, run_length, run_buf = tmp, cur_length, buf_offset
+            buf_offset += cur_length
+            bos_index += 1
+            book_offset = 0
+        if run_length:
+            yield run_start, run_length, run_buf
+
     # Provide ABC noop defaults.  Note they're not all actually noop.
     # Top men are insuring this works with multiple opens of a shelf.
 
@@ -313,7 +384,8 @@ class shadow_support(object):
         try:
             del self[(shelf.id, None)]
         except Exception as e:
-            set_trace()
+            self.logger.error('Shadow unlink(%s) failed: %s' % (
+                shelf.name, str(e)))
             raise
         return 0
 
@@ -351,7 +423,7 @@ class shadow_support(object):
     # Idiot checking and UNcaching: shadow_support
     def release(self, fh):                  # Must be an fh, not an fd
         cached = self[(None, fh)]
-        retval = deepcopy(cached)
+        retval = cached._clone()
         retval.open_handle = fh             # could be larger list
         del self[(None, fh)]
         return retval
@@ -422,12 +494,31 @@ class shadow_support(object):
                 sys.exc_info()[2].tb_lineno, str(e)))
             return 'ERROR'
 
+    @staticmethod
+    def _fadvise_sequential(fd):
+        '''Ask for the larger readahead window for streamed shelves.
+           Readahead still only triggers on sequential access.'''
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError) as e:     # just a hint
+            pass
+
     def read(self, shelf, length, offset, fd):
         raise TmfsOSError(errno.ENOSYS)
 
+    def readinto(self, shelf, buf, offset, fd):
+        '''read() into a caller-owned writable buffer, returns the byte
+           count.  Subclasses that can fill buf directly override this.'''
+        data = self.read(shelf, len(buf), offset, fd)
+        buf[:len(data)] = data
+        return len(data)
+
     def write(self, shelf, buf, offset, fd):
         raise TmfsOSError(errno.ENOSYS)
 
+    def flush(self, fh):
+        return 0
+
     def ioctl(self, shelf, cmd, arg, fh, flags, data):
         return -1
 
@@ -439,30 +530,72 @@ class shadow_directory(shadow_support):
        will exist in the file system of the entity running lfs_fuse,
        ie, if you're on a VM, the file storage is in the VM disk image.'''
 
+    _WRITEQ_DEPTH = 256     # write-behind backlog before write() blocks
+
     def __init__(self, args, lfs_globals):
         args.addr_mode = self._MODE_FALLBACK    # FIXME: not tested
         super().__init__(args, lfs_globals)
         self.zero_on_unlink = False   # OS "clears" per-shelf backing file
         assert os.path.isdir(
             args.shadow_dir), 'No such directory %s' % args.shadow_dir
-        self._shadowpath = args.shadow_dir
-        try:
-            probe = tempfile.TemporaryFile(dir=args.shadow_dir)
-            probe.close()
-        except OSError as e:
+        self._shadowpath = args.shadow_dir + '/'   # see shadowpath()
+        self._fd_fh = { }       # kernel sees fds, the cache is keyed by fh
+        if not os.access(args.shadow_dir, os.W_OK):
             raise RuntimeError('%s is not writeable' % args.shadow_dir)
 
+        # Optional write-behind: write() hands the data to a worker thread
+        # and returns.  Everything else that touches a backing file waits
+        # for that fd's queued writes first, and flush() reports errors.
+        self._writeq = None
+        if args.write_behind:
+            self._writeq = queue.Queue(maxsize=self._WRITEQ_DEPTH)
+            self._write_cond = threading.Condition()
+            self._write_pending = { }   # fd: writes queued, not yet done
+            self._write_errno = { }     # fd: errno of first failed write
+            threading.Thread(target=self._write_worker, daemon=True).start()
+
+    def _write_worker(self):
+        while True:
+            fd, buf, offset = self._writeq.get()
+            err = None
+            try:
+                buf = memoryview(buf)
+                while buf:              # keep going on a short write
+                    n = os.pwrite(fd, buf, offset)
+                    buf = buf[n:]
+                    offset += n
+            except OSError as e:
+                err = e.errno
+            except Exception as e:      # this thread must not die
+                self.logger.error('write-behind fd %d: %s' % (fd, str(e)))
+                err = errno.EIO
+            with self._write_cond:
+                if err is not None:
+                    self._write_errno.setdefault(fd, err)
+                self._write_pending[fd] -= 1
+                if not self._write_pending[fd]:
+                    del self._write_pending[fd]
+                    self._write_cond.notify_all()
+
+    def _drain(self, fd):
+        '''Wait for this fd's queued writes, other fds can keep going.'''
+        if self._writeq is None:
+            return
+        with self._write_cond:
+            self._write_cond.wait_for(lambda: fd not in self._write_pending)
+            err = self._write_errno.pop(fd, None)
+        if err is not None:
+            raise TmfsOSError(err)
+
     def shadowpath(self, shelf_name):
-        return '%s/%s' % (self._shadowpath, shelf_name)
+        return self._shadowpath + shelf_name
 
-    def unlink(self, shelf_name):
+    def unlink(self, shelf):
         # FIXME: not tested since unlink was expanded to do zeroing
-        for k, v in self.items():
-            if v[0].name == shelf_name:
-                del self[k]
-                break
+        # Cache is keyed by shelf id; that one delete drops every fh too.
+        super().unlink(shelf)
         try:
-            return os.unlink(self.shadowpath(shelf_name))
+            return os.unlink(self.shadowpath(shelf.name))
         except OSError as e:
             if e.errno == errno.ENOENT:
                 return 0
@@ -479,38 +612,56 @@ class shadow_directory(shadow_support):
                     raise TmfsOSError(e.errno)
             else:
                 raise TmfsOSError(e.errno)
+            return
+        self._fadvise_sequential(shelf._fd)
 
     def open(self, shelf, flags, mode=None):
         self._create_open_common(shelf, flags, mode)
         super().open(shelf, flags, mode)    # caching
+        self._fd_fh[shelf._fd] = shelf.open_handle
         return shelf._fd    # so kernel sees a real fd for mmap under FALLBACK
 
     def create(self, shelf, mode=None):
         flags = os.O_CREAT | os.O_RDWR | os.O_CLOEXEC
         self._create_open_common(shelf, flags, mode)
         super().create(shelf, mode)  # caching
+        self._fd_fh[shelf._fd] = shelf.open_handle
         return shelf._fd    # so kernel sees a real fd for mmap under FALLBACK
 
     def read(self, shelf_name, length, offset, fd):
-        assert self[shelf_name]._fd == fd, 'fd mismatch on read'
-        os.lseek(fd, offset, os.SEEK_SET)
-        return os.read(fd, length)
+        assert fd in self._fd_fh, 'fd mismatch on read'
+        self._drain(fd)
+        return os.pread(fd, length, offset)
+
+    def readinto(self, shelf_name, buf, offset, fd):
+        assert fd in self._fd_fh, 'fd mismatch on read'
+        self._drain(fd)
+        return os.preadv(fd, [buf], offset)
 
     def write(self, shelf_name, buf, offset, fd):
-        assert self[shelf_name]._fd == fd, 'fd mismatch on write'
-        os.lseek(fd, offset, os.SEEK_SET)
-        return os.write(fd, buf)
+        assert fd in self._fd_fh, 'fd mismatch on write'
+        if self._writeq is not None:
+            with self._write_cond:
+                self._write_pending[fd] = self._write_pending.get(fd, 0) + 1
+            self._writeq.put((fd, bytes(buf), offset))  # blocks when full
+            return len(buf)
+        return os.pwrite(fd, buf, offset)
+
+    def flush(self, fd):
+        self._drain(fd)
+        return 0
 
     def truncate(self, shelf, length, fd):  # shadow_dir, yes an fd
+        self._drain(fd)
         try:
             if fd:  # It's an open shelf
-                assert self[shelf.name]._fd == fd, 'fd mismatch on truncate'
+                assert fd in self._fd_fh, 'fd mismatch on truncate'
             os.truncate(
                 shelf._fd if shelf._fd >= 0 else self.shadowpath(shelf.name),
                 length)
             shelf.size_bytes = length
             if shelf.open_handle is None:
-                shelf = self[shelf.id]
+                shelf = self._by_id.get(shelf.id)
                 if shelf is not None:
                     shelf.size_bytes = length
             return 0
@@ -518,18 +669,26 @@ class shadow_directory(shadow_support):
             raise TmfsOSError(e.errno)
 
     def release(self, fd):              # shadow_dir: yes this is an fd
+        # flush() already had its chance to report a deferred write error,
+        # release() can't, so log it.  Write-behind data is only durable
+        # once it's fsync'ed.
+        lost = None
+        if self._writeq is not None:
+            try:
+                self._drain(fd)
+                os.fsync(fd)
+            except (TmfsOSError, OSError) as e:
+                lost = e.errno
         os.close(fd)                    # never a raise()
-        for shelf in self.values():     # search for fd to uncache shelf
-            if shelf._fd == fd:
-                for v in shelf.open_handle.values():
-                    fh = v[0]
-                    break
-                break
-        else:
+        try:
+            fh = self._fd_fh.pop(fd)    # no search of the cached shelves
+        except KeyError as e:
             raise RuntimeError('release: fd=%s is not cached' % fd)
-        super().release(fh)
-        shelf.open_handle = fh
+        shelf = super().release(fh)     # a copy, the cache is untouched
         shelf._fd = -1
+        if lost is not None:
+            self.logger.error('release(%s): write-behind data lost: %s' % (
+                shelf.name, os.strerror(lost)))
         return shelf
 
 #--------------------------------------------------------------------------
@@ -545,22 +704,20 @@ class shadow_file(shadow_support):
         (head, tail) = os.path.split(args.shadow_file)
         assert os.path.isdir(head), 'No such directory %s' % head
 
-        try:
-            probe = tempfile.TemporaryFile(dir=head)
-            probe.close()
-        except OSError as e:
+        if not os.access(head, os.W_OK):
             raise RuntimeError('%s is not writeable' % head)
 
-        if os.path.isfile(args.shadow_file):
-            fd = os.open(args.shadow_file, os.O_RDWR)
-        else:
-            fd = os.open(args.shadow_file, os.O_RDWR | os.O_CREAT)
-            size = lfs_globals['nvm_bytes_total']
-            os.ftruncate(fd, size)
+        # Sparse is fine: only blocks that get written take up space, so
+        # a new or short file is just extended, no preallocation.
+        fd = os.open(args.shadow_file, os.O_RDWR | os.O_CREAT)
+        statinfo = os.fstat(fd)
+        if statinfo.st_size < lfs_globals['nvm_bytes_total']:
+            os.ftruncate(fd, lfs_globals['nvm_bytes_total'])
+            statinfo = os.fstat(fd)
         self._shadow_fd = fd
+        self._fadvise_sequential(fd)
 
         # Compare node requirements to actual file size
-        statinfo = os.stat(args.shadow_file)
         assert self._S_IFREG_URW == self._S_IFREG_URW & statinfo.st_mode, \
             '%s is not RW'
         assert statinfo.st_size >= lfs_globals['nvm_bytes_total']
@@ -573,79 +730,73 @@ class shadow_file(shadow_support):
 
     def read(self, shelf_name, length, offset, fd):
 
-        if ((offset % self.book_size) + length) <= self.book_size:
+        if ((offset & self.book_mask) + length) <= self.book_size:
             shadow_offset = self.shadow_offset(shelf_name, offset)
-            os.lseek(self._shadow_fd, shadow_offset, os.SEEK_SET)
-            return os.read(self._shadow_fd, length)
-
-        # Read overlaps books, split into multiple chunks
-
-        buf = b''
-        cur_offset = offset
-        tot_length = length
-
-        while (tot_length > 0):
-            cur_length = min((self.book_size - (cur_offset % self.book_size)),
-                             tot_length)
-            shadow_offset = self.shadow_offset(shelf_name, cur_offset)
-
+            return os.pread(self._shadow_fd, length, shadow_offset)
+
+        # Read overlaps books, one preallocated buffer for all chunks.
+        buf = bytearray(length)
+        nbytes = self.readinto(shelf_name, buf, offset, fd)
+        del buf[nbytes:]
+        return bytes(buf)
+
+    def readinto(self, shelf_name, buf, offset, fd):
+        # Each chunk lands directly in its slice of buf.
+        view = memoryview(buf)
+        nbytes = 0
+        # Loop-invariant lookups as locals.  The logger formats lazily.
+        preadv = os.preadv
+        shadow_fd = self._shadow_fd
+        debug = self.logger.debug
+        for shadow_offset, cur_length, buf_offset in self._book_chunks(
+                shelf_name, offset, len(view)):
             if shadow_offset == -1:
                 break
 
-            os.lseek(self._shadow_fd, shadow_offset, os.SEEK_SET)
-            buf += os.read(self._shadow_fd, cur_length)
+            nread = preadv(shadow_fd,
+                           [view[buf_offset:buf_offset + cur_length]],
+                           shadow_offset)
 
-            self.logger.debug(
-                "READ: co = %d, tl = %d, cl = %d, so = %d, bl = %d" % (
-                  cur_offset, tot_length, cur_length,
-                  shadow_offset, len(buf)))
+            debug("READ: bo = %d, cl = %d, so = %d, nr = %d",
+                  buf_offset, cur_length, shadow_offset, nread)
 
-            offset += cur_length
-            cur_offset += cur_length
-            tot_length -= cur_length
+            nbytes += nread
+            if nread < cur_length:  # EOF on the shadow file
+                break
 
-        return buf
+        view.release()
+        return nbytes
 
     def write(self, shelf_name, buf, offset, fd):
 
-        if ((offset % self.book_size) + len(buf)) <= self.book_size:
+        if ((offset & self.book_mask) + len(buf)) <= self.book_size:
             shadow_offset = self.shadow_offset(shelf_name, offset)
-            os.lseek(self._shadow_fd, shadow_offset, os.SEEK_SET)
-            return os.write(self._shadow_fd, buf)
+            return os.pwrite(self._shadow_fd, buf, shadow_offset)
 
-        # Write overlaps books, split into multiple chunks
+        # Write overlaps books, split into multiple chunks.  The pieces
+        # are views into buf, not copies of it.
 
-        tbuf = b''
-        buf_offset = 0
-        cur_offset = offset
-        tot_length = len(buf)
+        view = memoryview(buf)
         wsize = 0
-
-        while (tot_length > 0):
-            cur_length = min((self.book_size - (cur_offset % self.book_size)),
-                             tot_length)
-            shadow_offset = self.shadow_offset(shelf_name, cur_offset)
-
+        # Loop-invariant lookups as locals.  The logger formats lazily.
+        pwrite = os.pwrite
+        shadow_fd = self._shadow_fd
+        debug = self.logger.debug
+        for shadow_offset, cur_length, buf_offset in self._book_chunks(
+                shelf_name, offset, len(buf)):
             assert shadow_offset != -1, "shadow_offset -1 during write"
 
-            # chop buffer in pieces
-            buf_end = buf_offset + cur_length
-            tbuf = buf[buf_offset:buf_end]
-
-            os.lseek(self._shadow_fd, shadow_offset, os.SEEK_SET)
-            wsize += os.write(self._shadow_fd, tbuf)
+            nwritten = pwrite(shadow_fd,
+                              view[buf_offset:buf_offset + cur_length],
+                              shadow_offset)
+            wsize += nwritten
 
-            self.logger.debug(
-                "WRITE: co = %d, tl = %d, cl = %d, so = %d,"
-                " bl = %d, bo = %d, wsize = %d, be = %d" % (
-                  cur_offset, tot_length, cur_length, shadow_offset,
-                  len(tbuf), buf_offset, wsize, buf_end))
+            debug("WRITE: bo = %d, cl = %d, so = %d, wsize = %d",
+                  buf_offset, cur_length, shadow_offset, wsize)
 
-            offset += cur_length
-            cur_offset += cur_length
-            tot_length -= cur_length
-            buf_offset += cur_length
-            tbuf = b''
+            # pwrite() may come up short, don't leave a hole behind it
+            if nwritten < cur_length:
+                break
 
         return wsize
 
@@ -673,6 +824,9 @@ class apertures(shadow_support):
     _BOOKLET_SHIFT = 16             # Bits of offset for 17 bit booklet number
     _BOOKLET_MASK = ((1 << 17) - 1)  # Mask for 17 bit booklet number
 
+    # ioctl request code is fixed, don't rebuild it on every ioctl().
+    _LFS_GET_PHYS_FROM_OFFSET = IOCTL.IOWR(ord("L"), 0x01, ctypes.c_ulong)
+
     def __init__(self, args, lfs_globals):
         '''args needs to have valid attributes for IVSHMEM and descriptors.'''
 
@@ -694,11 +848,12 @@ class apertures(shadow_support):
             assert xattr.startswith('_obtain_lza_for_page_fault'), \
                 'BAD KERNEL XATTR %s' % xattr
 
-            bos = self[(shelf.id, None)].bos
+            cached = self[(shelf.id, None)]
+            bos = cached.bos
             cmd, comm, pid, PABO = xattr.split(',')
             pid = int(pid)
             PABO = int(PABO)  # page-aligned byte offset into shelf
-            shelf_book_num = PABO // self.book_size  # (0..n-1)
+            shelf_book_num = PABO >> self.book_shift  # (0..n-1)
             if shelf_book_num >= len(bos):
                 return 'ERROR'
 
@@ -710,17 +865,20 @@ class apertures(shadow_support):
             else:
                 return 'ERROR'
 
-            # Remember, this IS in the kernel :-)
-            reason = cmd.split('_for_')[1]
-            self.logger.debug(
-                'Get LZA (%s): process %s[%d] shelf_id=%s, PABO=%d (0x%x)' %
-                (reason, comm, pid, shelf.name, PABO, PABO))
-            self.logger.debug(
-                'shelf book seq=%d, LZA=0x%x -> IG=%d, IGoffset=%d' % (
+            # Remember, this IS in the kernel :-)  One level check per
+            # fault, then no message is built unless it will be logged.
+            debug = self.logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                reason = cmd.split('_for_')[1]
+                self.logger.debug(
+                    'Get LZA (%s): process %s[%d] shelf_id=%s, PABO=%d (0x%x)',
+                    reason, comm, pid, shelf.name, PABO, PABO)
+                self.logger.debug(
+                    'shelf book seq=%d, LZA=0x%x -> IG=%d, IGoffset=%d',
                     shelf_book_num,
                     bookID,
                     ((bookID >> self._IG_SHIFT) & self._IG_MASK),
-                    ((bookID >> self._BOOK_SHIFT) & self._BOOK_MASK)))
+                    ((bookID >> self._BOOK_SHIFT) & self._BOOK_MASK))
 
             # FAME modes need the "flattened IG" address into the memory area.
             # shadow_offset() returns a full byte-accurate address (for use
@@ -732,9 +890,13 @@ class apertures(shadow_support):
                 if self.BIImode == BII.MODE_PHYSADDR:
                     map_addr = bookID
                 else:
-                    phys_offset = self.shadow_offset(shelf, PABO)
-                    if phys_offset == -1:
-                        return 'ERROR'
+                    # shadow_offset() without a second cache lookup; the
+                    # book number was range-checked against bos above.
+                    phys_offset = (self._cached_bases(cached)[shelf_book_num] +
+                                   (PABO & self.book_mask))
+                    if self.aperture_size:
+                        assert phys_offset < self.aperture_size, \
+                            'BAD SHADOW OFFSET'
                     map_addr = self.aperture_base + phys_offset
                     # tmp = baseBOS['id'] + PABO % self.book_size # yes it agrees
             elif self.addr_mode == self._MODE_1906_DESC:
@@ -742,7 +904,7 @@ class apertures(shadow_support):
                 # and DESBK is preprogrammed so LZA -> aperture number.
                 aper_num = ((bookID >> self._BOOK_SHIFT) & self._BOOK_MASK)
                 desc_offset = aper_num * self.book_size
-                book_offset = PABO % self.book_size
+                book_offset = PABO & self.book_mask
                 map_addr = self.aperture_base + desc_offset + book_offset
             elif self.addr_mode == self._MODE_FULL_DESC:
                 # MUST be done in kernel because zbridge slot lookup is needed
@@ -751,7 +913,8 @@ class apertures(shadow_support):
                 raise RuntimeError('Unimplemented mode %d' % self.addr_mode)
 
             data = '%d,%s,%s' % (self.addr_mode, bookID, map_addr)
-            self.logger.debug('data returned to fault handler = %s' % (data))
+            if debug:
+                self.logger.debug('data returned to fault handler = %s', data)
             return data
 
         except Exception as e:
@@ -761,9 +924,7 @@ class apertures(shadow_support):
 
     def ioctl(self, shelf_name, cmd, arg, fh, flags, data):
 
-        LFS_GET_PHYS_FROM_OFFSET = IOCTL.IOWR(ord("L"), 0x01, ctypes.c_ulong)
-
-        if (cmd == LFS_GET_PHYS_FROM_OFFSET):
+        if (cmd == self._LFS_GET_PHYS_FROM_OFFSET):
 
             # data ---
             #   in : byte offset into shelf
@@ -784,9 +945,9 @@ class apertures(shadow_support):
             ctypes.memmove(data, outbuf, 8)
 
             self.logger.info(
-                "LFS_GET_PHYS_FROM_OFFSET: shelf_name = %s" % shelf_name)
-            self.logger.info("offset = %d (0x%x), physaddr = %d (0x%x)" %
-                             (offset, offset, physaddr, physaddr))
+                "LFS_GET_PHYS_FROM_OFFSET: shelf_name = %s", shelf_name)
+            self.logger.info("offset = %d (0x%x), physaddr = %d (0x%x)",
+                             offset, offset, physaddr, physaddr)
 
             return 0
         else:
@@ -795,12 +956,47 @@ class apertures(shadow_support):
 #--------------------------------------------------------------------------
 # Called before the class is initialized.
 
+_SYSFS_PCI = '/sys/bus/pci/devices'
+
+# Kernel IORESOURCE_xxx bits (include/linux/ioport.h) in sysfs "resource"
+_IORESOURCE_PREFETCH = 0x00002000
+_IORESOURCE_MEM_64 = 0x00100000
+_IORESOURCE_UNASSIGNED = 0x30000000    # IORESOURCE_DISABLED | _UNSET
+
+
+def _find_ivshmem():
+    '''First (by BDF) Red Hat IVSHMEM device, 1af4:1110, straight from
+       sysfs instead of forking lspci.  None if there isn't one.'''
+    def sysfs_int(bdf, name):
+        with open(os.path.join(_SYSFS_PCI, bdf, name)) as f:
+            return int(f.read().strip(), 16)
+
+    try:
+        bdfs = sorted(os.listdir(_SYSFS_PCI))
+    except OSError as e:
+        return None
+    for bdf in bdfs:
+        try:
+            if (sysfs_int(bdf, 'vendor') != 0x1af4 or
+                    sysfs_int(bdf, 'device') != 0x1110):
+                continue
+            # One "start end flags" line per resource, BAR2 is the third
+            with open(os.path.join(_SYSFS_PCI, bdf, 'resource')) as f:
+                start, end, flags = [
+                    int(v, 16) for v in f.readlines()[2].split() ]
+            revision = sysfs_int(bdf, 'revision')
+        except (OSError, IndexError, ValueError) as e:
+            continue
+        return GenericObject(bdf=bdf, revision=revision,
+                             start=start, end=end, flags=flags)
+    return None
+
+
 def _detect_memory_space(args, lfs_globals):
     '''Not compatible with, and will ignore, other shadow_xxxx options.'''
     # Discern ivshmem information.  Our convention states the first
-    # IVSHMEM device found is used as fabric-attached memory.  Parse the
-    # first block of lines of lspci -vv for Bus-Device-Function and
-    # BAR2 information.
+    # IVSHMEM device found is used as fabric-attached memory.  Get its
+    # Bus-Device-Function and BAR2 information from sysfs.
 
     args.BIImode = lfs_globals['BIImode']
     if args.BIImode == BII.MODE_PHYSADDR:
@@ -813,23 +1009,16 @@ def _detect_memory_space(args, lfs_globals):
         args.logger.debug('addr_mode = MODE_FAME with per-IG physaddr (990x)')
         return
 
-    lspci = getoutput('lspci -vv -d1af4:1110').split('\n')[:11]
-    line1 = lspci[0]    # Might say "lspci: command not found"
-    if 'lspci' in line1:
-        raise RuntimeError('lspci command must be installed')
-
+    ivshmem = _find_ivshmem()
     ivshmemOK = False
-    if 'Red Hat, Inc' in line1:
-        RHstanza = 'Inter-VM shared memory'
-        # QEMU      Tested  line1
-        # <= 2.4:   x86_64  endswith(RHstanza)
-        # == 2.5:   aarch64 contains RHstanza, endswith(" (Rev 01)")
-        # == 2.6:   aarch64 contains RHstanza, endswith(" (rev 01)") YES lower r
+    if ivshmem is not None:
+        # QEMU      Tested  revision
+        # <= 2.4:   x86_64  any
+        # == 2.5:   aarch64 01
+        # == 2.6:   aarch64 01
         machine = os.uname().machine
         ivshmemOK = machine == 'x86_64' or (
-                    machine == 'aarch64' and
-                    line1.lower().endswith(' (rev 01)'))
-        ivshmemOK = ivshmemOK and RHstanza in line1
+                    machine == 'aarch64' and ivshmem.revision == 1)
 
     # If not FAME/IVSHMEM, ass-u-me it's TMAS or real TM.  Hardcode the
     # direct descriptor mode for now, Zbridge preloads all 1906.
@@ -850,29 +1039,15 @@ def _detect_memory_space(args, lfs_globals):
             lfs_globals['book_size_bytes']
         return
 
-    # Should be FAME, start parsing lspci output.
-    elems = line1.split()
-    bdf = elems[0]
-
-    region2 = [ l for l in lspci[1:] if 'Region 2:' in l ][0]
-    assert ('(64-bit, prefetchable)' in region2), \
-        'IVSHMEM region 2 not found for device %s' % bdf
-    assert ('ignored' not in region2), \
+    # Should be FAME, use the BAR2 numbers from sysfs.
+    bdf = ivshmem.bdf
+    assert ivshmem.start and not ivshmem.flags & _IORESOURCE_UNASSIGNED, \
         'IVSHMEM region 2 has no memory %s' % bdf
-    args.aperture_base = int(region2.split('Memory at')[1].split()[0], 16)
-    assert args.aperture_base, \
-        'Could not retrieve region 2 address of IVSHMEM device at %s' % bdf
-
-    # At 2.6 resource2 file went away, just detect size from line " [size=64G]"
-    size = region2.split('size=')[1][:-1]   # kill the right bracket
-    assert size[-1] in 'MGT', \
-        'Region 2 size not "G" or "T" for IVSHMEM device at %s' % bdf
-    if size[-1] == 'M':
-        args.aperture_size = int(size[:-1]) << 20
-    elif size[-1] == 'G':
-        args.aperture_size = int(size[:-1]) << 30
-    else:
-        args.aperture_size = int(size[:-1]) << 40
+    assert ivshmem.flags & _IORESOURCE_MEM_64 and \
+        ivshmem.flags & _IORESOURCE_PREFETCH, \
+        'IVSHMEM region 2 not found for device %s' % bdf
+    args.aperture_base = ivshmem.start
+    args.aperture_size = ivshmem.end - ivshmem.start + 1
 
     assert args.aperture_size, \
         'Could not retrieve region 2 size of IVSHMEM device at %s' % bdf
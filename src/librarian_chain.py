@@ -16,10 +16,15 @@
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
 from function_chain import Link, Chain
+from socket_handling import json_bytes
 import json
 
 from pdb import set_trace
 
+# Built once instead of behind every json.dumps()/json.loads() call
+_json_encode = json.JSONEncoder(separators=(',', ':')).encode
+_json_decode = json.JSONDecoder().decode
+
 
 class JSONDumpsLoadsLink(Link):
     """ Link that converts from dictionaries to json and vise-versa """
@@ -33,7 +38,7 @@ class JSONDumpsLoadsLink(Link):
         Returns:
             JSON string
         """
-        return json.dumps(obj)
+        return _json_encode(obj)
 
     def reverse(self, obj):
         """ JSON -> dictionary
@@ -44,7 +49,19 @@ class JSONDumpsLoadsLink(Link):
         Returns:
             Python dictionary object
         """
-        return json.loads(obj)
+        return _json_decode(obj)
+
+
+class JSONBytesLink(Link):
+    """ dictionaries <-> JSON bytes in one link, fusing the two above """
+
+    def forward(self, obj):
+        """ dictionary -> JSON byte string, same encoder as the sockets """
+        return json_bytes(obj)
+
+    def reverse(self, obj):
+        """ JSON byte string -> dictionary """
+        return _json_decode(obj.decode('utf-8'))
 
 
 class StrEncDecLink(Link):
@@ -80,5 +97,5 @@ class LibrarianChain(Chain):
 
     def __init__(self, parseargs=None):
         super().__init__()
-        self.append(JSONDumpsLoadsLink())
-        self.append(StrEncDecLink())
+        # One link either way, no intermediate str hop between two links
+        self.append(JSONBytesLink())
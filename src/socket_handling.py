@@ -25,7 +25,30 @@ import sys
 import time
 
 from pdb import set_trace
-from json import dumps, loads, JSONDecoder
+from json import dumps, loads, JSONDecoder, JSONEncoder
+
+# One encoder for every message; dumps() re-checks its keywords per call.
+_json_encode = JSONEncoder(separators=(',', ':')).encode
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_bytes(obj):
+    '''obj -> JSON bytes, via orjson when it's installed.'''
+    if orjson is not None:
+        # The receiver decodes each recv() as UTF-8 and could split a
+        # multibyte character, so only take ASCII output.  TypeError
+        # covers what orjson won't do, like ints wider than 64 bits.
+        try:
+            outbytes = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+            if outbytes.isascii():
+                return outbytes
+        except TypeError as e:
+            pass
+    return _json_encode(obj).encode()
 
 ###########################################################################
 # Located here because we have no utils module, this is low-level to client
@@ -187,7 +210,7 @@ class SocketReadWrite(object):
         self.sent = 0
         if JSON:
             # Error possible here: "not JSON serializable", let it raise
-            outbytes = dumps(obj).encode()
+            outbytes = json_bytes(obj)
         else:
             outbytes = obj.encode()
         logging.info('%s: sending %s' % (self,
@@ -223,8 +246,8 @@ class SocketReadWrite(object):
             raise OSError(errno.ECONNABORTED, 'Socket closed on prior error')
         except Exception as e:
             logging.error('%s: send_all failed: %s' % (self, str(e)))
-            set_trace()
-            pass
+            if sys.stdin.isatty():
+                set_trace()
             raise
         return False
 
@@ -285,7 +308,8 @@ class SocketReadWrite(object):
                     # Not ready; only happens on a fresh read with non-blocking
                     # mode (ie, can't happen in timeout mode).  Get back to
                     # select, or just re-recv?
-                    set_trace()     # probably created with selectable=True
+                    if sys.stdin.isatty():  # created with selectable=True?
+                        set_trace()
                     if not self._created_blocking:
                         return None
                     continue
@@ -593,9 +617,10 @@ class Server(SocketReadWrite):
                 try:    # process the next command
                     result, OOBmsg = handler(cmdict)
                 except Exception as e:  # Shouldn't happen
-                    set_trace()
                     msg = 'UNEXPECTED HANDLER ERROR: %s' % str(e)
                     logging.error('%s: %s' % (s, msg))
+                    if sys.stdin.isatty():
+                        set_trace()
                     raise
 
                 # NO "finally": it circumvents "continue" in error clause(s)
@@ -113,7 +113,8 @@ class SQLassist(object):
         for k, v in kwargs.items():
             setattr(self, k, v)
         self.DBconnect()            # In the derived class
-        self._iterclass = None
+        self._iterclass = self._iterbuild = None
+        self._desc = self._colnames = None     # see __next__
 
         return  # needs more work
 
@@ -148,6 +149,14 @@ class SQLassist(object):
             self._iterclass = cls
         else:
             raise ValueError('must be None, "generic", or a class name')
+        # Row builder for __next__: (column names, values) -> object
+        try:
+            self._iterbuild = self._iterclass.from_row
+        except AttributeError:
+            self._iterbuild = self._from_row_kwargs
+
+    def _from_row_kwargs(self, names, values):
+        return self._iterclass(**dict(zip(names, values)))
 
     def __iter__(self):
         return self
@@ -160,9 +169,13 @@ class SQLassist(object):
             raise StopIteration
         if self._iterclass is None:
             return r
-        cur = self._cursor
-        asdict = dict(zip([f[0] for f in cur.description], r))
-        return self._iterclass(**asdict)
+        # description is the same object for every row of one query so
+        # only extract the column names when it changes.
+        desc = self._cursor.description
+        if desc is not self._desc:
+            self._desc = desc
+            self._colnames = tuple([f[0] for f in desc])
+        return self._iterbuild(self._colnames, r)
 
     # Act like a cursor, except for the commit() method, because a cursor
     # doesn't have one.   Don't invoke methods here; rather, return a
@@ -33,12 +33,15 @@
 
 import stat
 import time
+from contextlib import contextmanager
 
 from pdb import set_trace
 
 from book_shelf_bos import TMBook, TMShelf, TMBos, TMOpenedShelves
 
 from frdnode import FRDnode, FRDFAModule, FRDintlv_group
+from frdnode import BooksIGInterpretation as BII
+from genericobj import GenericObject
 
 #--------------------------------------------------------------------------
 
@@ -107,12 +110,18 @@ class LibrarianDBackendSQL(object):
         except Exception as e:
             raise RuntimeError(str(e))
 
-        self._cur.execute('SELECT COUNT() FROM books WHERE allocated > 0')
-        r.books_used = self._cur.fetchone()[0]
-        if r.books_used is None:    # empty DB
-            r.books_used = 0
+        r.books_used = self.get_books_used()
         return r
 
+    def get_books_used(self):
+        ''' The only dynamic field of get_globals(): count of books in use.
+        '''
+        self._cur.execute('SELECT COUNT() FROM books WHERE allocated > 0')
+        books_used = self._cur.fetchone()[0]
+        if books_used is None:    # empty DB
+            books_used = 0
+        return books_used
+
     def get_nodes(self):
         ''' Retrieve info about all nodes configured into the DB.
             Input---
@@ -198,6 +207,43 @@ class LibrarianDBackendSQL(object):
         """
         return self._modify_table('books', book, (), commit)
 
+    def modify_books_alloc(self, book_ids, oldalloc, newalloc, commit=False):
+        """ Move a set of books from one allocation state to another.
+            Input---
+              book_ids - ids of the books to change
+              oldalloc - state every book must currently be in
+              newalloc - new state
+              commit - persist the update now
+            Output---
+              None or raise error (a book was not in oldalloc)
+        """
+        if not book_ids:
+            return
+        self._cur.UPDATEMANY('books', 'allocated=? WHERE id=? AND allocated=?',
+            [ (newalloc, id, oldalloc) for id in book_ids ], commit=commit)
+
+    def modify_shelf_books_alloc(self, shelf_id, oldalloc, newalloc,
+                                 first_seq=1, commit=False):
+        """ Move every book on a shelf in oldalloc to newalloc, in SQL.
+            Input---
+              shelf_id - shelf whose BOS entries select the books
+              oldalloc - only books currently in this state are changed
+              newalloc - new state
+              first_seq - skip books before this sequence number
+              commit - persist the update now
+            Output---
+              number of books changed
+        """
+        self._cur.execute('''UPDATE books SET allocated=?
+                             WHERE allocated=? AND id IN (
+                                SELECT book_id FROM books_on_shelves
+                                WHERE shelf_id=? AND seq_num>=?)''',
+                          (newalloc, oldalloc, shelf_id, first_seq))
+        changed = self._cur.rowcount
+        if commit:
+            self._cur.commit()
+        return changed
+
     def modify_shelf(self, shelf, commit=False):
         """ Modify data for an individual shelf.
             Input---
@@ -309,10 +355,35 @@ class LibrarianDBackendSQL(object):
         assert len(books) <= 1, 'Matched more than one book'
         return books[0] if books else None
 
+    # The SQL text only depends on the shape of the query, not the values,
+    # so build it once per shape.  Identical text also lets the sqlite3
+    # module reuse its prepared statement.
+    _books_by_IG_cache = { }
+
+    @classmethod
+    def _books_by_IG_sql(cls, nalloc, nIGs, exclude, order):
+        key = (nalloc, nIGs, exclude, order)
+        sql = cls._books_by_IG_cache.get(key)
+        if sql is None:
+            if nIGs:
+                INclause = 'AND intlv_group %s IN (%s)' % (
+                    'NOT' if exclude else '', ','.join('?' * nIGs))
+            else:
+                INclause = ''
+            ALLOCclause = 'WHERE allocated IN (%s)' % ','.join('?' * nalloc)
+            sql = '''SELECT * from books
+                     %s
+                     %s
+                     ORDER BY %s
+                     LIMIT ?''' % (ALLOCclause, INclause, order)
+            cls._books_by_IG_cache[key] = sql
+        return sql
+
     def get_books_by_intlv_group(self, max_books, IGs,
                                  allocated=None,
                                  exclude=False,
-                                 ascending=True):
+                                 ascending=True,
+                                 random=False):
         """ Retrieve available book(s) from given interleave group.
             Input---
               max_books - maximum number of books
@@ -322,49 +393,74 @@ class LibrarianDBackendSQL(object):
                           'ANY'=any
               exclude - treat IGs as exclusion filter: NOT IN (....)
               ascending - order by book_id == LZA
+              random - random selection, overrides ascending
             Output---
               List of TMBooks up to max_books or raised error
         """
         if allocated is None:
-            allocated = [TMBook.ALLOC_FREE]
+            allocated = (TMBook.ALLOC_FREE, )
         elif allocated == 'ANY':
             allocated = range(6)    # get them all and then some
-        if IGs:
-            INclause = 'AND intlv_group %%s IN (%s)' % ','.join(
-                (str(i) for i in IGs))
-            INclause = INclause % ('NOT' if exclude else '')
+        allocated = tuple(allocated)
+        IGs = tuple(IGs) if IGs else ()
+        # Let SQLite pick random rows so only max_books are ever fetched
+        if random:
+            order = 'RANDOM()'
         else:
-            INclause = ''
-        ALLOCclause = 'WHERE allocated IN (%s)' % ','.join(
-            (str(i) for i in allocated))
-        order = 'ASC' if ascending else 'DESC'
-        # SQL injection yeah yeah yeah can't avoid these
-        sql = '''SELECT * from books
-                 %s
-                 %s
-                 ORDER BY id %s
-                 LIMIT ?''' % (ALLOCclause, INclause, order)
-        self._cur.execute(sql, (max_books))
+            order = 'id ASC' if ascending else 'id DESC'
+        sql = self._books_by_IG_sql(len(allocated), len(IGs), exclude, order)
+        self._cur.execute(sql, allocated + IGs + (max_books, ))
         self._cur.iterclass = TMBook
         book_data = [ r for r in self._cur ]
         return book_data
 
-    def get_books_on_shelf(self, shelf):
+    def get_books_on_shelf(self, shelf, first_seq=1):
         """ Retrieve all books on a shelf.
             Input---
               shelf
+              first_seq - skip books before this sequence number
             Output---
               book data or None
         """
         self._cur.execute('''
             SELECT id, intlv_group, book_num, allocated, attributes
             FROM books JOIN books_on_shelves ON books.id = book_id
-            WHERE shelf_id = ? ORDER BY seq_num''',
-            shelf.id)
+            WHERE shelf_id = ? AND seq_num >= ? ORDER BY seq_num''',
+            (shelf.id, first_seq))
         self._cur.iterclass = TMBook
         books = [ r for r in self._cur ]
         return books
 
+    def get_shelf_alloc_counts(self, shelf_id, first_seq=1):
+        """ Tally the allocation states of the books on a shelf.
+            Input---
+              shelf_id - shelf identifier
+              first_seq - skip books before this sequence number
+            Output---
+              dict of allocated state: book count
+        """
+        self._cur.execute('''
+            SELECT allocated, COUNT(*)
+            FROM books JOIN books_on_shelves ON books.id = book_id
+            WHERE shelf_id = ? AND seq_num >= ? GROUP BY allocated''',
+            (shelf_id, first_seq))
+        return dict(self._cur.fetchall())
+
+    def get_shelf_intlv_groups(self, shelf):
+        """ Retrieve the interleave group of each book on a shelf.
+            Input---
+              shelf
+            Output---
+              bytes of IG numbers in seq_num order
+        """
+        self._cur.execute('''
+            SELECT intlv_group & ?
+            FROM books JOIN books_on_shelves ON books.id = book_id
+            WHERE shelf_id = ? ORDER BY seq_num''',
+            (BII.IG_MASK, shelf.id))
+        self._cur.iterclass = None
+        return bytes(r[0] for r in self._cur)
+
     def get_book_all(self):
         """ Retrieve book-level info about all books in all interleave groups.
             Input---
@@ -416,10 +512,11 @@ class LibrarianDBackendSQL(object):
     # Always commit, it's where the shelf.id comes from.
     #
 
-    def create_shelf(self, shelf):
+    def create_shelf(self, shelf, commit=True):
         """ Create one new shelf in the database.
             Input---
               shelf_data - list of shelf data to insert
+              commit - persist the insert now
             Output---
               shelf_data or error message
         """
@@ -430,7 +527,7 @@ class LibrarianDBackendSQL(object):
         shelf.ctime = shelf.mtime = tmp
         if shelf.parent_id == 0:
             shelf.parent_id = 2  # is now a default for if it given to go in root
-        shelf.id = self._cur.INSERT('shelves', shelf.tuple())
+        shelf.id = self._cur.INSERT('shelves', shelf.tuple(), commit=commit)
         return shelf
 
     def create_symlink(self, shelf, target):
@@ -479,6 +576,35 @@ class LibrarianDBackendSQL(object):
         # and may take surgery on the socket data return values.
         return shelf
 
+    def get_shelf_bundle(self, shelf, want_bos=True, want_open_count=True):
+        """ Retrieve a shelf along with the pieces destroy needs, in as
+            few statements as possible (open count rides on the shelf row).
+            Input---
+              shelf - as for get_shelf()
+              want_bos - include the TMBooks on the shelf in BOS order
+              want_open_count - include the number of opens on the shelf
+            Output---
+              GenericObject(shelf, bos, open_count) or None
+        """
+        fields = shelf.matchfields
+        qmarks = self._fields2qmarks(fields, ' AND ')
+        if want_open_count:
+            sql = '''SELECT *, (SELECT COUNT(*) FROM opened_shelves
+                                WHERE shelf_id=shelves.id) AS _open_count
+                     FROM shelves WHERE %s''' % qmarks
+        else:
+            sql = 'SELECT * FROM shelves WHERE %s' % qmarks
+        self._cur.execute(sql, shelf.tuple(fields))
+        rows = self._cur.fetchall()
+        assert len(rows) <= 1, 'Matched more than one shelf'
+        if not rows:
+            return None
+        row = dict(zip([ f[0] for f in self._cur.description ], rows[0]))
+        open_count = row.pop('_open_count', None)
+        shelf = TMShelf(row)
+        bos = self.get_books_on_shelf(shelf) if want_bos else None
+        return GenericObject(shelf=shelf, bos=bos, open_count=open_count)
+
     def get_shelf_openers(self, shelf, context, include_me=False):
         """ Retrieve a list of actors holding a shelf open.
             Input---
@@ -568,6 +694,19 @@ class LibrarianDBackendSQL(object):
         self._cur.INSERT('books_on_shelves', bos.tuple(), commit=commit)
         return(bos)
 
+    def create_bos_many(self, bos_list, commit=False):
+        """ Insert several new book-on-shelf mappings into the database.
+            Input---
+              bos_list - list of TMBos to insert
+            Output---
+              status: success = bos_list
+                      failure = raise XXXXX
+        """
+        if bos_list:
+            self._cur.INSERTMANY('books_on_shelves',
+                [ bos.tuple() for bos in bos_list ], commit=commit)
+        return bos_list
+
     def get_bos_by_shelf_id(self, shelf_id):
         """ Retrieve all bos entries from "books_on_shelves" table
             given a shelf_id.
@@ -585,6 +724,19 @@ class LibrarianDBackendSQL(object):
         bos = [ r for r in self._cur ]
         return bos
 
+    def get_bos_summary(self, shelf_id):
+        """ Sanity numbers for a shelf's bos entries without fetching them.
+            Input---
+              shelf_id - shelf identifier
+            Output---
+              (count, distinct seq_nums, min seq_num, max seq_num)
+        """
+        self._cur.execute('''SELECT COUNT(*), COUNT(DISTINCT seq_num),
+                                    MIN(seq_num), MAX(seq_num)
+                             FROM books_on_shelves WHERE shelf_id=?''',
+                          shelf_id)
+        return self._cur.fetchone()
+
     def get_bos_by_book_id(self, book_id):
         """ Retrieve THE bos entries given a book_id.
             Input---
@@ -625,6 +777,39 @@ class LibrarianDBackendSQL(object):
             self._cur.commit()
         return(bos)
 
+    def copy_bos_reversed(self, shelf_id, first_seq, last_seq,
+                          to_shelf_id, to_first_seq, commit=False):
+        """ Map a run of one shelf's books onto another shelf in reverse
+            order (last_seq lands on to_first_seq) with one INSERT...SELECT.
+            Input---
+              shelf_id, first_seq, last_seq - the source run, inclusive
+              to_shelf_id, to_first_seq - where it lands
+            Output---
+              None or raise error
+        """
+        self._cur.execute('''INSERT INTO books_on_shelves
+                             SELECT ?, book_id, ? - seq_num
+                             FROM books_on_shelves
+                             WHERE shelf_id=? AND seq_num BETWEEN ? AND ?''',
+                          (to_shelf_id, last_seq + to_first_seq, shelf_id,
+                           first_seq, last_seq))
+        if self._cur.rowcount != last_seq - first_seq + 1:
+            self._cur.rollback()
+            raise AssertionError('BOS copy failed: rowcount mismatch')
+        if commit:
+            self._cur.commit()
+
+    def delete_bos_by_shelf_id(self, shelf_id, first_seq=1, commit=False):
+        """ Delete every bos mapping for a shelf in one statement.
+            Input---
+              shelf_id - shelf identifier
+              first_seq - keep mappings before this sequence number
+            Output---
+              None or raise error
+        """
+        self._cur.DELETE('books_on_shelves', 'shelf_id=? AND seq_num>=?',
+                         (shelf_id, first_seq), commit=commit)
+
     def get_xattr(self, shelf, xattr, exists_only=False):
         '''Retrieve the data for a the specified extended attribute for the
            given shelf.
@@ -650,10 +835,18 @@ class LibrarianDBackendSQL(object):
         tmp = [ f[0] for f in self._cur.fetchall() ]
         return tmp
 
-    def create_xattr(self, shelf, xattr, value):
+    def create_xattr(self, shelf, xattr, value, commit=True):
         '''Store a new extended attribute name and value for a shelf.
         '''
-        self._cur.INSERT('shelf_xattrs', (shelf.id, xattr, value))
+        self._cur.INSERT('shelf_xattrs', (shelf.id, xattr, value),
+                         commit=commit)
+
+    def create_xattrs(self, shelf, xattrs, commit=False):
+        '''Store several (name, value) extended attributes for a shelf.
+        '''
+        self._cur.INSERTMANY('shelf_xattrs',
+                             [ (shelf.id, x, v) for x, v in xattrs ],
+                             commit=commit)
 
     def remove_xattr(self, shelf, xattr):
         '''Retrieve an extended attribute name and value for a shelf.
@@ -662,6 +855,12 @@ class LibrarianDBackendSQL(object):
                                          (shelf.id, xattr),
                                          commit=True)
 
+    def remove_all_xattrs(self, shelf, commit=False):
+        '''Remove every extended attribute of a shelf in one statement.
+        '''
+        self._cur.DELETE('shelf_xattrs', 'shelf_id=?', (shelf.id, ),
+                         commit=commit)
+
     # Basic operations (SELECT, custom DELETEs) need the cursor but
     # using it directly feels "clunky".  Hide it behind facades for
     # anything not matching the above methods.  Iteration requires
@@ -678,5 +877,23 @@ class LibrarianDBackendSQL(object):
     def __iter__(self):
         return self._cur
 
+    @contextmanager
+    def transaction(self):
+        """ Group several writes into one commit.
+            Usage---
+              with db.transaction():
+                  db.this(...)  # all with commit=False
+                  db.that(...)
+            Commits on normal exit, rolls back and re-raises on error.
+        """
+        # The connection's isolation level begins the transaction on
+        # the first write, so there is no explicit BEGIN here.
+        try:
+            yield self
+        except BaseException:
+            self._cur.rollback()
+            raise
+        self._cur.commit()
+
     def __getattr__(self, name):
         return getattr(self._cur, name)
@@ -408,6 +408,7 @@ class TMFS(object):
         self.operations = operations
         self.raw_fi = raw_fi
         self.encoding = encoding
+        self._readinto = getattr(operations, 'readinto', None) is not None
 
         args = ['tmfs']
 
@@ -540,6 +541,13 @@ class TMFS(object):
         else:
           fh = fip.contents.fh
 
+        if self._readinto:
+            # Fill the tmfs reply buffer in place rather than copying a
+            # returned string into it.
+            view = memoryview(cast(buf, POINTER(c_ubyte * size)).contents)
+            return self.operations('readinto', path.decode(self.encoding),
+                                   view.cast('B'), offset, fh)
+
         ret = self.operations('read', path.decode(self.encoding), size,
                                       offset, fh)
 
@@ -549,7 +557,6 @@ class TMFS(object):
         assert retsize <= size, \
             'actual amount read %d greater than expected %d' % (retsize, size)
 
-        data = create_string_buffer(ret, retsize)
         memmove(buf, ret, retsize)
         return retsize
 
@@ -871,6 +878,11 @@ class Operations(object):
 
         raise TmfsOSError(EIO)
 
+    # Optional: readinto(path, buf, offset, fh) fills the writable buffer
+    # buf (len(buf) is the size requested) and returns the byte count.
+    # If defined it is used instead of read().
+    readinto = None
+
     def readdir(self, path, fh):
         '''
         Can return either a list of names, or a list of (name, attrs, offset)
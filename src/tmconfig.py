@@ -22,9 +22,10 @@
 # Provide convenience properties that are entire collections, i.e.,
 # obj.mediaControllers.
 
-import inspect
 import json
+import linecache
 import os
+import re
 import sys
 
 from pdb import set_trace
@@ -39,40 +40,77 @@ try:
 except Exception as e:
     from genericobj import GenericObject    # __main__ below
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 ###########################################################################
 
 
+_SUFFIX_MULT = {
+    'K': 1 << 10,
+    'M': 1 << 20,
+    'G': 1 << 30,
+    'T': 1 << 40,
+}
+
+
+def _maybe_integer(instr):
+    '''False if int() can't take instr or instr minus a suffix character.'''
+    lead = instr[:1]
+    if lead in '+-':
+        lead = instr[1:2]
+    return lead.isdigit() or lead.isspace()
+
+
 def multiplier(instr, section, book_size_bytes=0):
     '''this is used as a probe function for integers.  Return or raise.'''
+    # Names, coordinates and certificates can be rejected by their first
+    # character or two without raising out of int() twice.
+    if not _maybe_integer(instr):
+        raise ValueError('"%s" is not an integer' % instr.strip()[:-1])
     try:
-        rsize = int(instr)
-        return rsize                    # that was easy
+        return int(instr)               # that was easy
     except ValueError as e:
-        try:
-            instr = instr.strip()
-            base = instr[:-1]
-            rsize = int(base)           # so far so good
-            suffix = instr[-1].upper()  # chomp one
-            if suffix not in 'BKMGT':
-                raise ValueError(
-                    'Illegal multiplier "%s" in [%s]' % (suffix, section))
-        except ValueError as e:
-            raise ValueError('"%s" is not an integer' % base)
-    if suffix == 'K':
-        return rsize * 1024
-    if suffix == 'M':
-        return rsize * 1024 * 1024
-    elif suffix == 'G':
-        return rsize * 1024 * 1024 * 1024
-    elif suffix == 'T':
-        return rsize * 1024 * 1024 * 1024 * 1024
-
-    # Suffix is 'B' to reach this point
+        pass
+    instr = instr.strip()
+    base = instr[:-1]
+    try:
+        rsize = int(base)               # so far so good
+    except ValueError as e:
+        raise ValueError('"%s" is not an integer' % base)
+    suffix = instr[-1].upper()          # chomp one
+    mult = _SUFFIX_MULT.get(suffix)
+    if mult is not None:
+        return rsize * mult
+    if suffix != 'B':
+        raise ValueError(
+            'Illegal multiplier "%s" in [%s]' % (suffix, section))
     if not book_size_bytes:
         raise ValueError(
             'multiplier suffix "B" not useable in [%s]' % section)
     return rsize * book_size_bytes
 
+
+def _flat_object(element):
+    '''True if a JSON object holds no lists or objects.'''
+    for value in element.values():
+        if isinstance(value, (list, dict)):
+            return False
+    return True
+
+
+def _unroll_flat(obj, element):
+    '''unroll() of a flat JSON object (most MCs) without the stack.'''
+    for attr, item in element.items():
+        if isinstance(item, str) and _maybe_integer(item):
+            try:    # probe for integer, maybe with multiplier
+                item = multiplier(item, attr)
+            except Exception as e:
+                pass
+        setattr(obj, attr, item)
+
 ###########################################################################
 # Because Drew.
 
@@ -130,10 +168,10 @@ class OptionBaseOneTuple(GenericObject):
 
     def __getitem__(self, index):
         if self._ob1:
-            if not index:
-                raise IndexError('first index is 1')
-            if index > 0:
+            if index > 0:       # the usual case, test it first
                 index -= 1
+            elif not index:
+                raise IndexError('first index is 1')
         return self._value[index]
 
 ###########################################################################
@@ -160,41 +198,29 @@ class _GOnodes(GenericObject):
     __qualname__ = 'node'
     __title__ = 'Node'
 
+    # dotname, hostname and node_id are plain attributes filled in by
+    # TMConfig.__init__() once rack, enc and node are known.
+
     def __init__(self, **kwargs):
-        assert 'hostname' not in kwargs, '"hostname" collides with property'
+        assert 'hostname' not in kwargs, '"hostname" is set from the SOC'
         super().__init__(**kwargs)
-        self._hostname = None
         # Trickle-down effect from 990 PHYSADDR.  It will always be zero here.
         # Only used in book_register.py.
         self.nvm_physaddr = [0,]
 
-    @property
-    def dotname(self):
-        return 'rack.%s.enc.%s.node.%s' % (self.rack, self.enc, self.node)
-
-    @property
-    def hostname(self):     # see the first line of TMConfig.__init__()
-        if self._hostname is None:
-            # MFT/FRD: rack is always "1", or words like "A1.above_floor"
-            self._hostname = 'node%02d' % (
-                (int(self.enc) - 1) * 10 +
-                int(self.node)
-            )
-        return self._hostname
-
-    @hostname.setter
-    def hostname(self, value):
-        self._hostname = str(value)
-
-    @property
-    def node_id(self):
-        return ((self.enc - 1) * 10 ) + self.node
-
 
 class _GOmediaControllers(GenericObject):
     __qualname__ = 'mediaController'
     __title__ = 'MediaController'
 
+# JSON key -> class for unroll(), anything else is anonymous.
+_GO_TABLE = {
+    'racks': _GOracks,
+    'enclosures': _GOenclosures,
+    'nodes': _GOnodes,
+    'mediaControllers': _GOmediaControllers,
+}
+
 ###########################################################################
 
 
@@ -204,8 +230,11 @@ class tupledict(tuple):
 
     def __init__(self, inseq):
         self._value = inseq
+        self._matches = { }     # snippet -> tuple, coordinates are final
 
     def __getitem__(self, index_or_key):
+        if isinstance(index_or_key, int):
+            return self._value[index_or_key]
         try:
             i = int(index_or_key)
             return self._value[i]   # IndexError will raise out
@@ -213,7 +242,10 @@ class tupledict(tuple):
             pass
         try:
             key = str(index_or_key)
-            tmp = tuple(i for i in self._value if key in i.coordinate)
+            tmp = self._matches.get(key)
+            if tmp is None:
+                tmp = tuple(i for i in self._value if key in i.coordinate)
+                self._matches[key] = tmp
             return tmp
         except Exception:
             return None
@@ -227,60 +259,78 @@ class TMConfig(GenericObject):
     @staticmethod
     def unroll(obj, attr, item, depth=0, verbose=False):
         '''attr is a JSON key and is camel case (usually lower).'''
+        # Depth-first walk with an explicit stack, in the same order the
+        # recursive version took.  Children are pushed in reverse so they
+        # pop in JSON order.  A list is frozen by a marker entry (depth
+        # None) pushed beneath its elements, so it pops after all of them.
+        GO_get = _GO_TABLE.get
+        stack = [(obj, attr, item, depth)]
         try:
-            if verbose:
-                print('    ' * depth, attr, end=': ')
-            if isinstance(item, list):
-                # MOST list elements are dicts.  The only exception as of
-                # 2016-06-22 is the array of strings in the InterleaveGroup
-                # mediaController expansion.
-                if verbose:
-                    print('(list)')
-                buildlist = []
-                setattr(obj, attr, buildlist)
-                for i, element in enumerate(item):
-                    if (isinstance(element, int) or
-                        isinstance(element, float) or
-                        isinstance(element, str)):
-                            buildlist.append(element)
-                    elif isinstance(element, dict):
-                        GO = globals().get('_GO' + attr, _GOanon)()
-                        buildlist.append(GO)
-                        for key, value in element.items():
-                            TMConfig.unroll(GO, key, value, depth + 1, verbose)
-                    else:
-                        print('Unexpected JSON construction', file=sys.stderr)
-                        set_trace()
-                        continue
-
-                # Make buildlist immutable and Drewable
-                tmp = getattr(obj, attr)
-                assert tmp is buildlist, 'This is sooooo not good'
-                tmp = OptionBaseOneTuple(buildlist, attr=attr)
-                setattr(obj, attr, tmp)
+            while stack:
+                obj, attr, item, depth = stack.pop()
+                if depth is None:
+                    # Make buildlist immutable and Drewable
+                    tmp = getattr(obj, attr)
+                    assert tmp is item, 'This is sooooo not good'
+                    tmp = OptionBaseOneTuple(item, attr=attr)
+                    setattr(obj, attr, tmp)
+                    continue
 
-            elif isinstance(item, dict):
                 if verbose:
-                    print('(dict)')
-                GO = globals().get('_GO' + attr, _GOanon)()
-                setattr(obj, attr, GO)
-                for key, value in item.items():
-                    TMConfig.unroll(GO, key, value, depth + 1, verbose)
+                    print('    ' * depth, attr, end=': ')
+                if isinstance(item, list):
+                    # MOST list elements are dicts.  The only exception as of
+                    # 2016-06-22 is the array of strings in the InterleaveGroup
+                    # mediaController expansion.
+                    if verbose:
+                        print('(list)')
+                    buildlist = []
+                    setattr(obj, attr, buildlist)
+                    children = []
+                    for i, element in enumerate(item):
+                        if (isinstance(element, int) or
+                            isinstance(element, float) or
+                            isinstance(element, str)):
+                                buildlist.append(element)
+                        elif isinstance(element, dict):
+                            GO = GO_get(attr, _GOanon)()
+                            buildlist.append(GO)
+                            if not verbose and _flat_object(element):
+                                _unroll_flat(GO, element)
+                                continue
+                            children.extend((GO, key, value, depth + 1)
+                                            for key, value in element.items())
+                        else:
+                            print('Unexpected JSON construction',
+                                  file=sys.stderr)
+                            set_trace()
+                            continue
+                    stack.append((obj, attr, buildlist, None))
+                    stack.extend(reversed(children))
+
+                elif isinstance(item, dict):
+                    if verbose:
+                        print('(dict)')
+                    GO = GO_get(attr, _GOanon)()
+                    setattr(obj, attr, GO)
+                    if not verbose and _flat_object(item):
+                        _unroll_flat(GO, item)
+                        continue
+                    stack.extend((GO, key, value, depth + 1)
+                                 for key, value in reversed(item.items()))
 
-            else:   # assume scalar, end of recursion
-                if verbose:
-                    if isinstance(item, str):
-                        print(item[:40], '...')
-                    else:
-                        print(item)
-                if isinstance(item, str):
-                    try:    # probe for integer, maybe with multiplier
-                        item = multiplier(item, attr)
-                    except Exception as e:
-                        pass
-                if attr == 'hostname':
-                    pass
-                setattr(obj, attr, item)
+                else:   # assume scalar, end of this branch
+                    if verbose:
+                        if isinstance(item, str):
+                            print(item[:40], '...')
+                        else:
+                            print(item)
+                    if isinstance(item, str) and _maybe_integer(item):
+                        try:    # probe for integer, maybe with multiplier
+                            item = multiplier(item, attr)
+                        except Exception as e:
+                            pass
+                    setattr(obj, attr, item)
 
         except Exception as e:    # Syntax, logic, whatever; I'm done
             print('Line %d: %s' % (
@@ -305,21 +355,28 @@ class TMConfig(GenericObject):
         'Enclosure', 'EncNum', 'Node', 'MemoryBoard', 'SocBoard'
     )
     _StudlyCase = dict(zip([e.lower() for e in _StudlyKeys], _StudlyKeys))
+    # Whole coordinate elements that are a key in any case.
+    _StudlyRE = re.compile(
+        r'(?i)(?<![^/])(?:%s)(?![^/])' % '|'.join(_StudlyKeys))
 
     def finish_child(self, child, parent=None):
-        '''Establish fwd/rev links, validate and extend coordinates'''
+        '''Establish fwd/rev links, validate and extend coordinates.
+           Returns the last coordinate element (a string).'''
         # Initial setup and error checking
         child.parent = parent
         coord = child.coordinate
-        errhdr = '%s coordinate "%s" ' % (child.__class__.__title__, coord)
+        # Only format the header if there's an error to report.
+        errhdr = '%s coordinate "%s" '
+        errvars = (child.__class__.__title__, coord)
         if ' ' in coord:
-            self.errors.append(errhdr + 'has superfluous whitespace')
+            self.errors.append(errhdr % errvars + 'has superfluous whitespace')
 
         if parent is None:
             prefix = ''
         else:
             if coord.strip('/') != coord:
-                self.errors.append(errhdr + 'has leading or trailing "/"')
+                self.errors.append(
+                    errhdr % errvars + 'has leading or trailing "/"')
             prefix = parent.coordinate + '/'
             try:
                 parent.children.append(child)
@@ -328,30 +385,43 @@ class TMConfig(GenericObject):
 
         # Go ahead and do it, then validate
         # FIXME: calculate coordinate on the fly, instead of fixed val.
-        child.coordinate = prefix + coord
-        elems = coord.split('/')     # Parent gets checked earlier
-        for e in elems:
-            tmp = self._StudlyCase.get(e.lower(), e)
+        # Interned; the set and dict checks below compare identity first.
+        child.coordinate = sys.intern(prefix + coord)
+        # Parent gets checked earlier.  Only elements the regex finds can
+        # be miscased keys; most coordinates have one or two.
+        studly = self._StudlyCase
+        for m in self._StudlyRE.finditer(coord):
+            e = m.group()
+            tmp = studly.get(e.lower(), e)
             if tmp != e:
-                self.errors.append(errhdr + 'case should be "%s"' % tmp)
+                self.errors.append(
+                    errhdr % errvars + 'case should be "%s"' % tmp)
+        return coord.rsplit('/', 1)[-1]     # also last of the absolute coord
 
     def __init__(self, path, verbose=False):
-        # Support for managing 'hostname' property in this class
+        # Back-reference from every node to this config
         setattr(_GOnodes, self.__class__.__name__, self)
         self.verbose = verbose
         self.FTFY = [ ]
         try:
-            with open(path, 'r') as f:
+            # Both parsers take the raw bytes; skip the decoded str copy.
+            with open(path, 'rb') as f:
                 original = f.read()
-            self._json = json.loads(original)
+            self._json = None
+            if orjson is not None:
+                try:
+                    self._json = orjson.loads(original)
+                except ValueError as e:
+                    pass    # json can say why, or take what orjson won't
+            if self._json is None:
+                self._json = json.loads(original)
             for key, value in self._json.items():
                 TMConfig.unroll(self, key, value, verbose=verbose)
         except Exception as e:
             tb_lineno = sys.exc_info()[2].tb_lineno
-            src, base_lineno = inspect.getsourcelines(self.__class__)
-            if not src:
+            badsrc = linecache.getline(__file__, tb_lineno).strip()
+            if not badsrc:
                 raise RuntimeError('Line %d: %s' % (tb_lineno, str(e)))
-            badsrc = src[tb_lineno - base_lineno][:-1].strip()
             raise RuntimeError(
                 'Line %d: "%s": %s' % (tb_lineno, badsrc, str(e)))
 
@@ -360,12 +430,20 @@ class TMConfig(GenericObject):
         # a lot of things.  The list gets used again for IG checking.
 
         self._allServices = None
+        # The topology is fixed once unroll() is done; build these on
+        # first use and keep them.
+        self._allEnclosures = None
+        self._allNodes = None
+        self._allMediaControllers = None
+        self._totalNVM = None
         self.errors = [ ]
 
         # Duplicate detection
-        allencs = [ ]
-        allnodes = [ ]
+        allencs = set()
+        allnodes = set()
         fullMCs = { }
+        bookSize = None     # property walks services, look it up once
+        totalNVM = 0
 
         # Since unroll() blindly takes any keys, guard against typos.  Yes
         # it could be folded into finish_child but this sufficient for now.
@@ -382,37 +460,50 @@ class TMConfig(GenericObject):
         if not self.coordinate.startswith('/MachineVersion/1/'):
             self.errors.append('Illegal MachineVersion "%s"' % self.coordinate)
             # fall through, find other stuff
-        self.finish_child(self)
+        # One pass, serially: the work is pure Python, and errors must be
+        # reported in file order.
+        finish_child = self.finish_child
+        finish_child(self)
         for rack in self.racks:
-            self.finish_child(rack, self)
+            rack_num = finish_child(rack, self)
             enclooper = getchilditer(rack, 'enclosures')
             if not enclooper:
                 return
             for enc in enclooper:
-                self.finish_child(enc, rack)
+                enc_num = finish_child(enc, rack)
                 if enc.coordinate in allencs:
                     self.errors.append(
                         'Duplicate enclosure coordinate %s' % enc.coordinate)
                     continue
-                allencs.append(enc.coordinate)
+                allencs.add(enc.coordinate)
                 nodelooper = getchilditer(enc, 'nodes')
                 if not nodelooper:
                     return
                 for node in nodelooper:
-                    self.finish_child(node, enc)
+                    node_num = finish_child(node, enc)
                     if node.coordinate in allnodes:
                         self.errors.append(
                             'Duplicate node coordinate %s' % node.coordinate)
                         continue
-                    allnodes.append(node.coordinate)
-
-                    self.finish_child(node.soc, node)
-                    node.rack = rack.coordinate.split('/')[-1]  # string
-                    node.enc = int(enc.coordinate.split('/')[-1])
-                    node.node = int(node.coordinate.split('/')[-1])
+                    allnodes.add(node.coordinate)
+
+                    finish_child(node.soc, node)
+                    node.rack = rack_num    # string
+                    node.enc = int(enc_num)
+                    node.node = int(node_num)
+                    node.node_id = (node.enc - 1) * 10 + node.node
+                    node.dotname = 'rack.%s.enc.%s.node.%s' % (
+                        node.rack, node.enc, node.node)
+                    if 'hostname' in node.__dict__:     # from the JSON
+                        self.errors.append(
+                            'Node %s sets hostname, it belongs in the SOC' %
+                            node.coordinate)
                     if hasattr(node.soc, 'hostname'):
-                        node.hostname = node.soc.hostname   # property set
+                        node.hostname = str(node.soc.hostname)
                     else:
+                        # MFT/FRD: rack is always "1", or words like
+                        # "A1.above_floor"
+                        node.hostname = 'node%02d' % node.node_id
                         # This won't go over well in France.
                         self._FTFY(
                             ('hostname', ),
@@ -427,8 +518,18 @@ class TMConfig(GenericObject):
                     mclooper = getchilditer(node, 'mediaControllers')
                     if not mclooper:
                         return
+                    node.totalNVM = 0
+
+                    # CID == enc[11-9]:node[8-4]:subCID[3-0] making an
+                    # 11-bit CID.  External representations of full fields
+                    # are all option base 1, but each subfield of rawCID
+                    # must be option base 0.  SubCID is the GenZ responder
+                    # for MCs, runs from 8 - 11.
+                    CID_base = (((node.enc - 1) << 9) +
+                                ((node.node - 1) << 4) + 8)
                     for mc in mclooper:
-                        self.finish_child(mc, node)
+                        node.totalNVM += mc.memorySize  # even if duplicate
+                        subCID = finish_child(mc, node)
                         if mc.coordinate in fullMCs:
                             self.errors.append(
                                 'Duplicate MC coordinate %s' % mc.coordinate)
@@ -438,23 +539,16 @@ class TMConfig(GenericObject):
 
                         # FIXUP for alignment with frdnode.FAModule.  Real
                         # FRD HW only has 13 bits of book number in an LZA
-                        mc.module_size_books = mc.memorySize // self.bookSize
+                        if bookSize is None:
+                            bookSize = self.bookSize
+                        mc.module_size_books = mc.memorySize // bookSize
                         if mc.module_size_books > 8192:
                             self.errors.append(
                                 'MC @ %s has too much NVM' % mc.coordinate)
                             # keep going
 
-                        # CID == enc[11-9]:node[8-4]:subCID[3-0] making an
-                        # 11-bit CID.  External representations of full fields
-                        # are all option base 1, but each subfield of rawCID
-                        # must be option base 0.  SubCID is the GenZ responder
-                        # for MCs, runs from 8 - 11.
-                        subCID = int(mc.coordinate.split('/')[-1])
-                        mc.rawCID = (((int(node.enc) - 1) << 9) +
-                                     ((int(node.node) - 1) << 4) +
-                                     ((subCID - 1) + 8))
-                    node.totalNVM = sum(mc.memorySize
-                                        for mc in node.mediaControllers)
+                        mc.rawCID = CID_base + int(subCID) - 1
+                    totalNVM += node.totalNVM
 
                     # Find it earlier, report it with more clarity
                     self._FTFY(
@@ -464,9 +558,11 @@ class TMConfig(GenericObject):
                         (node.dotname, )
                     )
 
+        self._totalNVM = totalNVM   # all the nodes were summed above
+
         # IGs only have absolute coordinates; "update" them with node's full
         # definition.  fullMCs is now a "countdown" consistency check.
-        groupIds = [ ]
+        groupIds = set()
         IGlooper = getchilditer(self, 'interleaveGroups')
         if not IGlooper:
             return
@@ -474,7 +570,7 @@ class TMConfig(GenericObject):
             IG.coordinate = ''  # for completeness
             assert IG.groupId not in groupIds, \
                 'Duplicate interleave group ID %d' % IG.groupId
-            groupIds.append(IG.groupId)
+            groupIds.add(IG.groupId)
             updateMCs = [ ]
             mclooper = getchilditer(IG, 'mediaControllers')
             if not mclooper:
@@ -517,31 +613,42 @@ class TMConfig(GenericObject):
 
     @property
     def allEnclosures(self):
+        if self._allEnclosures is not None:
+            return self._allEnclosures
         # I think I'm missing something about nested comprehensions
         # when a closure is involved, so I fell back to explicit.
         enclosures = []
         for rack in self.racks:
             enclosures.extend(rack.enclosures)
-        return tupledict(enclosures)
+        self._allEnclosures = tupledict(enclosures)
+        return self._allEnclosures
 
     @property
     def allNodes(self):
+        if self._allNodes is not None:
+            return self._allNodes
         nodes = []
-        for rack in self.racks:
-            for enclosure in rack.enclosures:
-                nodes.extend(enclosure.nodes)
-        return tupledict(nodes)
+        for enclosure in self.allEnclosures:    # property ref
+            nodes.extend(enclosure.nodes)
+        self._allNodes = tupledict(nodes)
+        return self._allNodes
 
     @property
     def totalNVM(self):
-        return sum(node.totalNVM for node in self.allNodes)
+        # Only valid after __init__ has set node.totalNVM everywhere
+        if self._totalNVM is None:
+            self._totalNVM = sum(node.totalNVM for node in self.allNodes)
+        return self._totalNVM
 
     @property
     def allMediaControllers(self):
+        if self._allMediaControllers is not None:
+            return self._allMediaControllers
         MCs = []
         for node in self.allNodes:     # property ref
             MCs.extend(node.mediaControllers)
-        return tupledict(MCs)
+        self._allMediaControllers = tupledict(MCs)
+        return self._allMediaControllers
 
     @property
     def allIGs(self):
@@ -554,7 +661,9 @@ class TMConfig(GenericObject):
     def services(self):
         if self._allServices is not None:
             return self._allServices
-        self._allServices = { }
+        # Only cached once it's complete, so a failure is raised every time
+        # instead of leaving an empty dict behind for the next caller.
+        allServices = { }
 
         # There's old and new, but there could be both.  Try old first,
         # perhaps cobble up new style records and fall through.
@@ -593,8 +702,8 @@ class TMConfig(GenericObject):
             for server in self.servers:
                 hostname = server.ipv4Address
                 for service in server.services:
-                    assert service not in self._allServices, \
-                        'Duplicate service ' + service
+                    assert service.service not in allServices, \
+                        'Duplicate service ' + service.service
 
                     # Find it earlier, report it with more clarity
                     self._FTFY(
@@ -608,12 +717,13 @@ class TMConfig(GenericObject):
                             '${ipv4Address}', hostname)
                     except AttributeError as e:
                         pass
-                    self._allServices[service.service] = service
+                    allServices[service.service] = service
 
-        if not self._allServices:
+        if not allServices:
             raise RuntimeError('Cannot find any services')
 
-        return self._allServices
+        self._allServices = allServices
+        return allServices
 
     @property
     def bookSize(self):
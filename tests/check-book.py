@@ -36,29 +36,29 @@ def rw_mm(m, cur_offset, length, verbose, ops):
 
     failures = 0
     rand_index = random.randrange(0, len(global_rand_buf) - length);
+    obuf = global_rand_buf[rand_index:rand_index + length]  # slice once
+    end_offset = cur_offset + length
 
+    # Slicing addresses the map directly, no seek() bookkeeping needed
     if 'r' in ops:
-        m.seek(cur_offset)
-        ibuf = m.read(length)
+        ibuf = m[cur_offset:end_offset]
         if (verbose > 2):
             print("read: %s" % (binascii.hexlify(ibuf)))
 
     if 'w' in ops:
-        m.seek(cur_offset)
-        m.write(global_rand_buf[rand_index:rand_index + length])
+        m[cur_offset:end_offset] = obuf
         m.flush(cur_offset, length)
         if (verbose > 2):
             print("write: cur_offset = %d (0x%x), size = %d" %
                 (cur_offset, cur_offset, length))
-            print("write: %s" % (binascii.hexlify(global_rand_buf[rand_index:rand_index + length])))
+            print("write: %s" % (binascii.hexlify(obuf)))
 
     if 'v' in ops:
-        m.seek(cur_offset)
-        ibuf = m.read(length)
+        ibuf = m[cur_offset:end_offset]
         if (verbose > 2):
             print("read: %s" % (binascii.hexlify(ibuf)))
 
-        if global_rand_buf[rand_index:rand_index + length] == ibuf and length == len(ibuf):
+        if obuf == ibuf:    # bytes compare is a memcmp, lengths included
             if (verbose > 2):
                 print("verify passed")
         else:
@@ -72,29 +72,27 @@ def rw_fs(f, cur_offset, length, verbose, ops):
 
     failures = 0
     rand_index = random.randrange(0, len(global_rand_buf) - length);
+    obuf = global_rand_buf[rand_index:rand_index + length]  # slice once
+    fd = f.fileno()     # unbuffered, so positioned IO skips the lseek()s
 
     if 'r' in ops:
-        f.seek(cur_offset)
-        ibuf = f.read(length)
+        ibuf = os.pread(fd, length, cur_offset)
         if (verbose > 2):
             print("read: %s" % (binascii.hexlify(ibuf)))
 
     if 'w' in ops:
-        f.seek(cur_offset)
-        f.write(global_rand_buf[rand_index:rand_index + length])
-        f.flush()
+        os.pwrite(fd, obuf, cur_offset)
         if (verbose > 2):
             print("write: cur_offset = %d (0x%x), size = %d" %
                 (cur_offset, cur_offset, length))
-            print("write: %s" % (binascii.hexlify(global_rand_buf[rand_index:rand_index + length])))
+            print("write: %s" % (binascii.hexlify(obuf)))
 
     if 'v' in ops:
-        f.seek(cur_offset)
-        ibuf = f.read(length)
+        ibuf = os.pread(fd, length, cur_offset)
         if (verbose > 2):
             print("read: %s" % (binascii.hexlify(ibuf)))
 
-        if global_rand_buf[rand_index:rand_index + length] == ibuf and length == len(ibuf):
+        if obuf == ibuf:    # bytes compare is a memcmp, lengths included
             if (verbose > 2):
                 print("verify passed")
         else:
@@ -132,37 +130,54 @@ def rw_books(shelf_name, verbose, debug, book_max, length, book_size,
         m = mmap.mmap(f.fileno(), length=mmap_length, offset=mmap_offset)
         if (verbose > 2):
             print("mmap offset = %d, length = %d" % (mmap_offset, mmap_length))
+        # Tell the kernel the access pattern, where it has one.  "seq"
+        # only streams through the map when the chunks cover each book,
+        # otherwise it hops between books and readahead would be wasted.
+        if hasattr(m, 'madvise'):   # Python 3.8
+            if access_type == 'bounce':
+                m.madvise(mmap.MADV_RANDOM)
+            elif chunk_cnt * chunk_size >= book_size:
+                m.madvise(mmap.MADV_SEQUENTIAL)
+
+    # Chunk offsets within a book are the same for every book, so work
+    # them out once.  "bounce" alternates between the front and back.
+    if access_type == 'seq':
+        book_offsets = tuple(pos * chunk_size for pos in range(chunk_cnt))
+    else:
+        book_offsets = tuple(
+            (pos - pos // 2) * chunk_size if pos % 2 == 0 else
+            book_size - (pos - pos // 2) * chunk_size
+            for pos in range(chunk_cnt))
+
+    # Per-chunk trace is only for verbose > 1; test that once and write
+    # pre-built lines rather than going through print() per chunk.
+    trace = verbose > 1
+    write = sys.stdout.write
+    chunk_fmt = "[%2d/%s] book %4d: pos = %d, book_offset = 0x%012x cur_offset = 0x%012x, size = %d"
+    skip_fmt = chunk_fmt + " (skipped due to verify header)\n"
+    chunk_fmt += "\n"
 
     while cur_iter <= max_iter:
 
         while book_num < book_end:
 
-            for pos in range(0, chunk_cnt):
-
-                if access_type == 'seq':
-                    book_offset = (pos * chunk_size)
-                else:
-                    pos2 = pos - pos // 2
-                    if pos%2 == 0:
-                        book_offset = (pos2 * chunk_size)
-                    else:
-                        book_offset = book_size - (pos2 * chunk_size)
+            for pos, book_offset in enumerate(book_offsets):
 
                 cur_offset = offset + book_offset
 
                 # Skip reading/writing range occupied by header
                 if (cur_offset < header_len):
                     rw_length = length - (header_len - cur_offset)
-                    if rw_length <= 0 and verbose > 1:
-                        print("[%2d/%s] book %4d: pos = %d, book_offset = 0x%012x cur_offset = 0x%012x, size = %d (skipped due to verify header)" %
+                    if rw_length <= 0 and trace:
+                        write(skip_fmt %
                             (cur_iter, trans_type, book_num, pos, book_offset, cur_offset, length))
                     cur_offset = header_len
                 else:
                     rw_length = length
 
                 if rw_length > 0:
-                    if (verbose > 1):
-                        print("[%2d/%s] book %4d: pos = %d, book_offset = 0x%012x cur_offset = 0x%012x, size = %d" %
+                    if trace:
+                        write(chunk_fmt %
                             (cur_iter, trans_type, book_num, pos, book_offset, cur_offset, rw_length))
 
                     if trans_type == 'mm':
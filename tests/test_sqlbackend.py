@@ -0,0 +1,191 @@
+#!/usr/bin/python3 -tt
+
+# Copyright 2017 Hewlett Packard Enterprise Development LP
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, version 2 as
+# published by the Free Software Foundation.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+""" Unit tests for the set-oriented helpers in sqlbackend.py """
+
+import unittest
+import argparse
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+try:
+    import book_register
+    from backend_sqlite3 import LibrarianDBackendSQLite3
+    from book_shelf_bos import TMBook, TMShelf, TMBos
+except Exception as e:
+    raise SystemExit('Import(s) failed: %s' % str(e))
+
+_INI = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    '..', 'configfiles', 'book_data.ini')
+
+
+class TestSQLBackend(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # One book_register run, each test gets a private copy.
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.template = os.path.join(cls.tmpdir, 'template.db')
+        ret = subprocess.call(
+            [sys.executable, book_register.__file__, '-d', cls.template, _INI],
+            stdout=subprocess.DEVNULL)
+        assert ret == 0, 'book_register failed'
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def setUp(self):
+        self.db_file = os.path.join(self.tmpdir, self.id() + '.db')
+        shutil.copy(self.template, self.db_file)
+        self.db = LibrarianDBackendSQLite3(
+            argparse.Namespace(db_file=self.db_file))
+        self.books = [ b.id for b in self.db.get_book_all()[:6] ]
+
+    def tearDown(self):
+        self.db.close()
+        os.remove(self.db_file)
+
+    def committed(self, sql, values=()):
+        '''What another connection sees, ie, only committed data.'''
+        other = sqlite3.connect(self.db_file)
+        try:
+            return other.execute(sql, values).fetchall()
+        finally:
+            other.close()
+
+    def alloc(self, book_id):
+        return self.committed(
+            'SELECT allocated FROM books WHERE id=?', (book_id, ))[0][0]
+
+    def new_shelf(self, name, books):
+        shelf = self.db.create_shelf(TMShelf(name=name, parent_id=2))
+        self.db.modify_books_alloc(books, TMBook.ALLOC_FREE,
+                                   TMBook.ALLOC_INUSE)
+        self.db.create_bos_many(
+            [ TMBos(shelf_id=shelf.id, book_id=b, seq_num=seq)
+              for seq, b in enumerate(books, start=1) ], commit=True)
+        return shelf
+
+    def test_transaction_1(self):
+        # Normal exit commits every write inside the block
+        with self.db.transaction():
+            shelf = self.db.create_shelf(TMShelf(name='t1', parent_id=2),
+                                         commit=False)
+            self.db.modify_books_alloc(self.books[:2], TMBook.ALLOC_FREE,
+                                       TMBook.ALLOC_INUSE)
+        self.assertEqual(self.committed(
+            'SELECT COUNT(*) FROM shelves WHERE id=?', (shelf.id, )),
+            [(1, )])
+        for b in self.books[:2]:
+            self.assertEqual(self.alloc(b), TMBook.ALLOC_INUSE)
+
+    def test_transaction_2(self):
+        # An exception rolls back every write inside the block
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.create_shelf(TMShelf(name='t2', parent_id=2),
+                                     commit=False)
+                self.db.modify_books_alloc(self.books[:2], TMBook.ALLOC_FREE,
+                                           TMBook.ALLOC_INUSE)
+                raise RuntimeError('injected')
+        self.assertEqual(self.committed(
+            'SELECT COUNT(*) FROM shelves WHERE name=?', ('t2', )),
+            [(0, )])
+        for b in self.books[:2]:
+            self.assertEqual(self.alloc(b), TMBook.ALLOC_FREE)
+
+    def test_modify_books_alloc_1(self):
+        self.db.modify_books_alloc(self.books[:3], TMBook.ALLOC_FREE,
+                                   TMBook.ALLOC_INUSE, commit=True)
+        for b in self.books[:3]:
+            self.assertEqual(self.alloc(b), TMBook.ALLOC_INUSE)
+
+    def test_modify_books_alloc_2(self):
+        # The "AND allocated=?" guard rejects a book in the wrong state
+        # and the whole batch is rolled back.
+        self.db.modify_books_alloc(self.books[1:2], TMBook.ALLOC_FREE,
+                                   TMBook.ALLOC_INUSE, commit=True)
+        with self.assertRaises(AssertionError):
+            self.db.modify_books_alloc(self.books[:3], TMBook.ALLOC_FREE,
+                                       TMBook.ALLOC_INUSE)
+        self.assertEqual(self.alloc(self.books[0]), TMBook.ALLOC_FREE)
+        self.assertEqual(self.alloc(self.books[1]), TMBook.ALLOC_INUSE)
+        self.assertEqual(self.alloc(self.books[2]), TMBook.ALLOC_FREE)
+
+    def test_modify_books_alloc_3(self):
+        # Same guard inside a transaction: nothing of it survives
+        self.db.modify_books_alloc(self.books[2:3], TMBook.ALLOC_FREE,
+                                   TMBook.ALLOC_INUSE, commit=True)
+        with self.assertRaises(AssertionError):
+            with self.db.transaction():
+                self.db.create_shelf(TMShelf(name='t3', parent_id=2),
+                                     commit=False)
+                self.db.modify_books_alloc(self.books[:3], TMBook.ALLOC_FREE,
+                                           TMBook.ALLOC_INUSE)
+        self.assertEqual(self.committed(
+            'SELECT COUNT(*) FROM shelves WHERE name=?', ('t3', )),
+            [(0, )])
+        self.assertEqual(self.alloc(self.books[0]), TMBook.ALLOC_FREE)
+
+    def test_modify_shelf_books_alloc_1(self):
+        shelf = self.new_shelf('s1', self.books[:4])
+        changed = self.db.modify_shelf_books_alloc(
+            shelf.id, TMBook.ALLOC_INUSE, TMBook.ALLOC_ZOMBIE, first_seq=3,
+            commit=True)
+        self.assertEqual(changed, 2)
+        self.assertEqual(self.db.get_shelf_alloc_counts(shelf.id),
+                         { TMBook.ALLOC_INUSE: 2, TMBook.ALLOC_ZOMBIE: 2 })
+        self.assertEqual(self.db.get_shelf_alloc_counts(shelf.id, 3),
+                         { TMBook.ALLOC_ZOMBIE: 2 })
+        self.assertEqual(self.alloc(self.books[3]), TMBook.ALLOC_ZOMBIE)
+
+    def test_modify_shelf_books_alloc_2(self):
+        # Only books in oldalloc change
+        shelf = self.new_shelf('s2', self.books[:4])
+        self.db.modify_shelf_books_alloc(
+            shelf.id, TMBook.ALLOC_INUSE, TMBook.ALLOC_ZOMBIE, first_seq=4)
+        changed = self.db.modify_shelf_books_alloc(
+            shelf.id, TMBook.ALLOC_ZOMBIE, TMBook.ALLOC_FREE)
+        self.assertEqual(changed, 1)
+        self.assertEqual(self.db.get_shelf_alloc_counts(shelf.id),
+                         { TMBook.ALLOC_INUSE: 3, TMBook.ALLOC_FREE: 1 })
+
+    def test_copy_bos_reversed_1(self):
+        src = self.new_shelf('c1', self.books[:4])
+        dst = self.db.create_shelf(TMShelf(name='c2', parent_id=2))
+        self.db.copy_bos_reversed(src.id, 2, 4, dst.id, 1, commit=True)
+        self.assertEqual(
+            [ (b.book_id, b.seq_num)
+              for b in self.db.get_bos_by_shelf_id(dst.id) ],
+            [ (self.books[3], 1), (self.books[2], 2), (self.books[1], 3) ])
+
+    def test_copy_bos_reversed_2(self):
+        # A run reaching past the end of the shelf is a rowcount mismatch
+        src = self.new_shelf('c3', self.books[:4])
+        dst = self.db.create_shelf(TMShelf(name='c4', parent_id=2))
+        with self.assertRaises(AssertionError):
+            self.db.copy_bos_reversed(src.id, 3, 6, dst.id, 1)
+        self.assertEqual(self.db.get_bos_by_shelf_id(dst.id), [ ])
+
+
+if __name__ == '__main__':
+    unittest.main()